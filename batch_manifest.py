@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+def file_hash(path: str) -> str :
+	h = hashlib.sha256()
+	with open(path, 'rb') as fp :
+		for chunk in iter(lambda: fp.read(1024 * 1024), b'') :
+			h.update(chunk)
+	return h.hexdigest()
+
+class BatchManifest(object) :
+	"""Progress record of a batch run, kept in the destination directory.
+
+	Every state change is appended as one JSON line so a crash loses at most the
+	page being written, when loading the last line of each source file wins.
+	"""
+	def __init__(self, dst: str) :
+		self.path = os.path.join(dst, MANIFEST_NAME)
+		self.entries = {}
+		self._lock = threading.Lock()
+		if os.path.exists(self.path) :
+			with open(self.path, 'r', encoding = 'utf-8') as fp :
+				for line in fp :
+					try :
+						entry = json.loads(line)
+					except ValueError :
+						# partially written last line
+						continue
+					self.entries[entry['source']] = entry
+		self._fp = open(self.path, 'a', encoding = 'utf-8')
+
+	def is_finished(self, source: str, source_hash: str) -> bool :
+		entry = self.entries.get(source)
+		return entry is not None and entry['status'] == 'finished' and entry['hash'] == source_hash and os.path.exists(entry['output'])
+
+	def mark(self, source: str, source_hash: str, status: str, output: str) :
+		entry = {'source': source, 'hash': source_hash, 'status': status, 'output': output, 'time': time.time()}
+		with self._lock :
+			self.entries[source] = entry
+			self._fp.write(json.dumps(entry, ensure_ascii = False) + '\n')
+			self._fp.flush()
+
+	def close(self) :
+		self._fp.close()
@@ -0,0 +1,155 @@
+import random
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from text_rendering import text_render
+
+SAMPLE_TEXTS = {
+	'cjk': [
+		'どうしてこんなところにいるの？',
+		'お前は誰だ！',
+		'今日はいい天気ですね',
+		'待って、まだ話は終わってない',
+		'本当にそれでいいの？',
+		'大丈夫、私に任せて',
+		'这到底是怎么回事',
+		'我们必须马上离开这里！',
+	],
+	'latin': [
+		'What are you doing here?',
+		'Wait, I am not done talking yet!',
+		'It is a nice day today.',
+		'Leave it to me.',
+		'We have to get out of here right now!',
+		'Is that really okay with you?',
+	],
+}
+
+def parse_sizes(spec: str) -> List[Tuple[int, int]] :
+	"""Parse page sizes given as `1024x1536,2048x2048` into (width, height) tuples."""
+	sizes = []
+	for item in spec.split(',') :
+		if not item.strip() :
+			continue
+		w, h = item.lower().split('x')
+		sizes.append((int(w), int(h)))
+	if not sizes :
+		raise Exception(f'No page size in `{spec}`')
+	return sizes
+
+def _draw_panels(page: np.ndarray, rng: random.Random) :
+	height, width = page.shape[: 2]
+	margin = max(8, min(width, height) // 40)
+	thickness = max(2, min(width, height) // 300)
+	num_rows = rng.randint(2, 3)
+	ys = [margin] + sorted(rng.sample(range(height // 5, height * 4 // 5), num_rows - 1)) + [height - margin]
+	for top, bottom in zip(ys[: -1], ys[1:]) :
+		num_cols = rng.randint(1, 3)
+		xs = [margin] + sorted(rng.sample(range(width // 5, width * 4 // 5), num_cols - 1)) + [width - margin]
+		for left, right in zip(xs[: -1], xs[1:]) :
+			x0, y0, x1, y1 = left + margin // 2, top + margin // 2, right - margin // 2, bottom - margin // 2
+			if rng.random() < 0.5 :
+				# screentone dots
+				step = rng.randint(4, 8)
+				panel = page[y0: y1, x0: x1]
+				yy, xx = np.indices(panel.shape[: 2])
+				panel[(yy % step < 2) & (xx % step < 2)] = rng.randint(60, 160)
+			cv2.rectangle(page, (x0, y0), (x1, y1), (0, 0, 0), thickness)
+
+def _render_text(text: str, script: str, font_size: int, rng: random.Random) -> np.ndarray :
+	if script == 'cjk' :
+		return text_render.put_text_vertical(font_size, 1.0, text, rng.randint(4, 8) * font_size, (0, 0, 0), (255, 255, 255))
+	return text_render.put_text_horizontal(font_size, 1.0, text, rng.randint(6, 12) * font_size, (0, 0, 0), (255, 255, 255))
+
+def generate_page(width: int, height: int, num_bubbles: int, script: str = 'cjk', seed: int = 0) -> np.ndarray :
+	"""Draw a synthetic RGB manga page of panels, screentone and speech bubbles.
+
+	Bubble text is rendered with `text_render`, so `text_render.prepare_renderer`
+	must have been called. The same arguments always give the same page.
+	"""
+	if script not in SAMPLE_TEXTS :
+		raise Exception(f'Unknown script {script}, one of {list(SAMPLE_TEXTS)}')
+	rng = random.Random(seed)
+	page = np.full((height, width, 3), 255, dtype = np.uint8)
+	_draw_panels(page, rng)
+	font_size = max(12, min(width, height) // 40)
+	placed = []
+	for _ in range(num_bubbles) :
+		box = _render_text(rng.choice(SAMPLE_TEXTS[script]), script, font_size, rng)
+		if box.ndim != 3 or box.shape[2] != 4 :
+			continue
+		bh, bw = box.shape[: 2]
+		ax, ay = int(bw * 0.75) + font_size, int(bh * 0.75) + font_size
+		if ax * 2 >= width or ay * 2 >= height :
+			continue
+		# a few tries to keep bubbles from covering each other
+		for _ in range(20) :
+			cx, cy = rng.randint(ax, width - ax - 1), rng.randint(ay, height - ay - 1)
+			if all(abs(cx - px) > ax + pax or abs(cy - py) > ay + pay for (px, py, pax, pay) in placed) :
+				break
+		placed.append((cx, cy, ax, ay))
+		cv2.ellipse(page, (cx, cy), (ax, ay), 0, 0, 360, (255, 255, 255), -1)
+		cv2.ellipse(page, (cx, cy), (ax, ay), 0, 0, 360, (0, 0, 0), max(2, font_size // 8))
+		x, y = cx - bw // 2, cy - bh // 2
+		alpha = box[:, :, 3: 4].astype(np.float32) / 255.0
+		region = page[y: y + bh, x: x + bw].astype(np.float32)
+		page[y: y + bh, x: x + bw] = (region * (1 - alpha) + box[:, :, : 3].astype(np.float32) * alpha).astype(np.uint8)
+	return page
+
+def percentile(values: List[float], q: float) -> float :
+	"""Nearest-rank percentile, `q` in [0, 100]."""
+	if not values :
+		return 0.0
+	values = sorted(values)
+	rank = max(0, min(len(values) - 1, int(np.ceil(q / 100.0 * len(values))) - 1))
+	return values[rank]
+
+def latency_summary(values: List[float]) -> dict :
+	return {
+		'p50': round(percentile(values, 50), 4),
+		'p95': round(percentile(values, 95), 4),
+		'p99': round(percentile(values, 99), 4),
+		'mean': round(sum(values) / len(values), 4) if values else 0.0,
+	}
+
+def summarize(traces: List[dict], elapsed: float) -> dict :
+	"""Aggregate `TaskTrace.to_dict` results of the measured pages of one configuration."""
+	stages = {}
+	for trace in traces :
+		for s in trace['stages'] :
+			entry = stages.setdefault(s['stage'], {'wall': [], 'cpu': [], 'peak_rss_kb': 0, 'peak_rss_delta_kb': 0})
+			entry['wall'].append(s['wall'])
+			entry['cpu'].append(s['cpu'])
+			entry['peak_rss_kb'] = max(entry['peak_rss_kb'], s.get('peak_rss_kb', 0))
+			entry['peak_rss_delta_kb'] = max(entry['peak_rss_delta_kb'], s['peak_rss_delta_kb'])
+	return {
+		'pages': len(traces),
+		'elapsed': round(elapsed, 4),
+		'pages_per_second': round(len(traces) / elapsed, 4) if elapsed > 0 else 0.0,
+		'page': latency_summary([t['total_wall'] for t in traces]),
+		'stages': {
+			name: {
+				'wall': latency_summary(entry['wall']),
+				'cpu': latency_summary(entry['cpu']),
+				'peak_rss_kb': entry['peak_rss_kb'],
+				'peak_rss_delta_kb': entry['peak_rss_delta_kb'],
+			} for name, entry in stages.items()
+		},
+	}
+
+def format_report(results: List[dict]) -> str :
+	lines = []
+	for r in results :
+		lines.append(f"detector {r['detector']}, OCR {r['ocr_model']}, inpainting {r['inpainting_model']}: {r['pages']} pages, {r['pages_per_second']:.3f} pages/s")
+		lines.append(f"  {'stage':<16}{'p50':>10}{'p95':>10}{'p99':>10}{'peak MB':>10}{'+MB':>10}")
+		stages = r['stages'].values()
+		rows = list(r['stages'].items()) + [('page', {
+			'wall': r['page'],
+			'peak_rss_kb': max([s['peak_rss_kb'] for s in stages] + [0]),
+			'peak_rss_delta_kb': max([s['peak_rss_delta_kb'] for s in stages] + [0]),
+		})]
+		for name, s in rows :
+			lines.append(f"  {name:<16}{s['wall']['p50']:>10.3f}{s['wall']['p95']:>10.3f}{s['wall']['p99']:>10.3f}{s['peak_rss_kb'] / 1024:>10.1f}{s['peak_rss_delta_kb'] / 1024:>10.1f}")
+	return '\n'.join(lines)
@@ -1,7 +1,7 @@
 
 import torch
 import cv2
-from typing import List
+from typing import List, Tuple
 import numpy as np
 from utils import Quadrilateral
 from .DBNet_resnet34 import TextDetection as TextDetectionDefault
@@ -23,21 +23,15 @@ def load_model(cuda: bool, model_name: str = 'default') :
 			model = model.cuda()
 		DEFAULT_MODEL = model
 
-async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bool, args: dict) :
-	global DEFAULT_MODEL
+def preprocess_default(img: np.ndarray, detect_size: int, verbose: bool) :
 	img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(cv2.bilateralFilter(img, 17, 80, 80), detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
-	ratio_h = ratio_w = 1 / target_ratio
 	if verbose :
 		print(f'Detection resolution: {img_resized.shape[1]}x{img_resized.shape[0]}')
 	img_resized = img_resized.astype(np.float32) / 127.5 - 1.0
-	img = torch.from_numpy(img_resized)
-	if cuda :
-		img = img.cuda()
-	img = einops.rearrange(img, 'h w c -> 1 c h w')
-	with torch.no_grad() :
-		db, mask = DEFAULT_MODEL(img)
-		db = db.sigmoid().cpu()
-		mask = mask[0, 0, :, :].cpu().numpy()
+	return img_resized, 1 / target_ratio, pad_w, pad_h
+
+def postprocess_default(db: torch.Tensor, mask: np.ndarray, img_resized: np.ndarray, ratio: float, pad_w: int, pad_h: int, args: dict) :
+	ratio_h = ratio_w = ratio
 	det = dbnet_utils.SegDetectorRepresenter(args.text_threshold, args.box_threshold, unclip_ratio = args.unclip_ratio)
 	boxes, scores = det({'shape':[(img_resized.shape[0], img_resized.shape[1])]}, db)
 	boxes, scores = boxes[0], scores[0]
@@ -58,6 +52,33 @@ async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bo
 		mask_resized = mask_resized[:, : -pad_w]
 	return textlines, np.clip(mask_resized * 255, 0, 255).astype(np.uint8)
 
+async def run_default_batch(imgs: List[np.ndarray], detect_size: int, cuda: bool, verbose: bool, args: dict, max_batch_size: int = 4) :
+	global DEFAULT_MODEL
+	prepared = [preprocess_default(img, detect_size, verbose) for img in imgs]
+	# pages only share a forward pass when they resize to the same padded shape
+	groups = {}
+	for i, (img_resized, _, _, _) in enumerate(prepared) :
+		groups.setdefault(img_resized.shape, []).append(i)
+	results = [None] * len(imgs)
+	for indices in groups.values() :
+		for i in range(0, len(indices), max_batch_size) :
+			chunk = indices[i: i + max_batch_size]
+			batch = torch.from_numpy(np.stack([prepared[idx][0] for idx in chunk]))
+			if cuda :
+				batch = batch.cuda()
+			batch = einops.rearrange(batch, 'n h w c -> n c h w')
+			with torch.no_grad() :
+				db, mask = DEFAULT_MODEL(batch)
+				db = db.sigmoid().cpu()
+				mask = mask[:, 0, :, :].cpu().numpy()
+			for j, idx in enumerate(chunk) :
+				img_resized, ratio, pad_w, pad_h = prepared[idx]
+				results[idx] = postprocess_default(db[j: j + 1], mask[j], img_resized, ratio, pad_w, pad_h, args)
+	return results
+
+async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bool, args: dict) :
+	return (await run_default_batch([img], detect_size, cuda, verbose, args))[0]
+
 async def dispatch(img: np.ndarray, detect_size: int, cuda: bool, args: dict, model_name: str = 'default', verbose: bool = False) -> List[Quadrilateral] :
 	print(' -- Running text detection')
 	if model_name == 'default' :
@@ -66,3 +87,10 @@ async def dispatch(img: np.ndarray, detect_size: int, cuda: bool, args: dict, mo
 			load_model(cuda, 'default')
 		return await run_default(img, detect_size, cuda, verbose, args)
 
+async def dispatch_batch(imgs: List[np.ndarray], detect_size: int, cuda: bool, args: dict, model_name: str = 'default', verbose: bool = False, max_batch_size: int = 4) -> List[Tuple[List[Quadrilateral], np.ndarray]] :
+	print(f' -- Running text detection on {len(imgs)} images')
+	if model_name == 'default' :
+		global DEFAULT_MODEL
+		if DEFAULT_MODEL is None :
+			load_model(cuda, 'default')
+		return await run_default_batch(imgs, detect_size, cuda, verbose, args, max_batch_size)
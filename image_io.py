@@ -0,0 +1,37 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable
+
+from PIL import Image
+
+def prefetch(items: Iterable[tuple], load: Callable, num_workers: int = 2, buffer_size: int = 4) :
+	"""Yield `load(*item)` for every item in order, decoding up to `buffer_size` items ahead in background threads."""
+	buffer_size = max(1, buffer_size)
+	with ThreadPoolExecutor(max_workers = max(1, num_workers), thread_name_prefix = 'prefetch') as pool :
+		pending = deque()
+		for item in items :
+			pending.append(pool.submit(load, *item))
+			if len(pending) >= buffer_size :
+				yield pending.popleft().result()
+		while pending :
+			yield pending.popleft().result()
+
+class AsyncImageWriter(object) :
+	"""Encode and write images in background threads.
+
+	At most `max_pending` images are held in memory, `save` blocks once that many
+	are still waiting to be written.
+	"""
+	def __init__(self, num_workers: int = 2, max_pending: int = 8) :
+		self._pool = ThreadPoolExecutor(max_workers = max(1, num_workers), thread_name_prefix = 'writer')
+		self._slots = threading.Semaphore(max(1, max_pending))
+
+	def save(self, img: Image.Image, path: str) -> Future :
+		self._slots.acquire()
+		future = self._pool.submit(img.save, path)
+		future.add_done_callback(lambda _: self._slots.release())
+		return future
+
+	def close(self) :
+		self._pool.shutdown(wait = True)
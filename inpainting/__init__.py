@@ -7,34 +7,28 @@ from .inpainting_lama import get_generator as get_lama_generator
 from .inpainting_lama_mpe import load_lama_mpe, LamaFourier
 from utils import resize_keep_aspect
 
-INPAINTING_MODEL = None
+# name -> loaded model, several can be loaded side by side when benchmarking
+INPAINTING_MODELS = {}
 
 def load_model(cuda: bool, model_name: str = 'default') :
-	global INPAINTING_MODEL
 	if model_name not in ['default', 'lama', 'lama_mpe'] :
 		raise Exception
-	if model_name == 'default' and INPAINTING_MODEL is None :
+	if model_name in INPAINTING_MODELS :
+		return
+	if model_name == 'default' :
 		model = AOTGenerator()
 		sd = torch.load('inpainting.ckpt', map_location = 'cpu')
 		model.load_state_dict(sd['model'] if 'model' in sd else sd)
-		model.eval()
-		if cuda :
-			model = model.cuda()
-		INPAINTING_MODEL = model
-	if model_name == 'lama' and INPAINTING_MODEL is None :
+	elif model_name == 'lama' :
 		model = get_lama_generator()
 		sd = torch.load('inpainting_lama.ckpt', map_location = 'cpu')
 		model.load_state_dict(sd['model'] if 'model' in sd else sd)
-		model.eval()
-		if cuda :
-			model = model.cuda()
-		INPAINTING_MODEL = model
-	if model_name == 'lama_mpe' and INPAINTING_MODEL is None :
+	elif model_name == 'lama_mpe' :
 		model = load_lama_mpe('inpainting_lama_mpe.ckpt', device='cpu')
-		model.eval()
-		if cuda :
-			model = model.cuda()
-		INPAINTING_MODEL = model
+	model.eval()
+	if cuda :
+		model = model.cuda()
+	INPAINTING_MODELS[model_name] = model
 
 async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool, img: np.ndarray, mask: np.ndarray, inpainting_size: int = 1024, model_name: str = 'default', verbose: bool = False) -> np.ndarray :
 
@@ -66,7 +60,8 @@ async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool,
 		mask = cv2.resize(mask, (new_w, new_h), interpolation = cv2.INTER_LINEAR)
 	if verbose :
 		print(f'Inpainting resolution: {new_w}x{new_h}')
-	if isinstance(INPAINTING_MODEL, LamaFourier):
+	model = INPAINTING_MODELS[model_name]
+	if isinstance(model, LamaFourier):
 		img_torch = torch.from_numpy(img).permute(2, 0, 1).unsqueeze_(0).float() / 255.
 	else:
 		img_torch = torch.from_numpy(img).permute(2, 0, 1).unsqueeze_(0).float() / 127.5 - 1.0
@@ -78,8 +73,8 @@ async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool,
 		mask_torch = mask_torch.cuda()
 	with torch.no_grad() :
 		img_torch *= (1 - mask_torch)
-		img_inpainted_torch = INPAINTING_MODEL(img_torch, mask_torch)
-	if isinstance(INPAINTING_MODEL, LamaFourier):
+		img_inpainted_torch = model(img_torch, mask_torch)
+	if isinstance(model, LamaFourier):
 		img_inpainted = (img_inpainted_torch.cpu().squeeze_(0).permute(1, 2, 0).numpy() * 255.).astype(np.uint8)
 	else:
 		img_inpainted = ((img_inpainted_torch.cpu().squeeze_(0).permute(1, 2, 0).numpy() + 1.0) * 127.5).astype(np.uint8)
@@ -0,0 +1,94 @@
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+# seconds, from a quick OCR call to a manual translation
+DEFAULT_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple, extra: str = '') -> str :
+	parts = [f'{k}="{str(v)}"' for k, v in zip(label_names, label_values)]
+	if extra :
+		parts.append(extra)
+	return '{' + ','.join(parts) + '}' if parts else ''
+
+class Counter(object) :
+	def __init__(self, name: str, doc: str, label_names: Tuple[str, ...] = ()) :
+		self.name = name
+		self.doc = doc
+		self.label_names = label_names
+		self.values: Dict[Tuple, float] = {}
+		self._lock = threading.Lock()
+
+	def inc(self, *label_values, amount: float = 1) :
+		with self._lock :
+			self.values[label_values] = self.values.get(label_values, 0) + amount
+
+	def get(self, *label_values) -> float :
+		return self.values.get(label_values, 0)
+
+	def render(self) -> List[str] :
+		lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} counter']
+		for label_values, value in sorted(self.values.items()) :
+			lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+		return lines
+
+class Gauge(object) :
+	"""Value read when rendered, `func` returns a number or a dict of label values tuple -> number."""
+	def __init__(self, name: str, doc: str, func, label_names: Tuple[str, ...] = ()) :
+		self.name = name
+		self.doc = doc
+		self.func = func
+		self.label_names = label_names
+
+	def render(self) -> List[str] :
+		lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} gauge']
+		values = self.func()
+		if not isinstance(values, dict) :
+			values = {(): values}
+		for label_values, value in sorted(values.items()) :
+			lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+		return lines
+
+class Histogram(object) :
+	def __init__(self, name: str, doc: str, label_names: Tuple[str, ...] = (), buckets: List[float] = DEFAULT_BUCKETS) :
+		self.name = name
+		self.doc = doc
+		self.label_names = label_names
+		self.buckets = sorted(buckets)
+		# label values -> (per bucket counts with +Inf last, sum, count)
+		self.values: Dict[Tuple, list] = {}
+		self._lock = threading.Lock()
+
+	def observe(self, value: float, *label_values) :
+		with self._lock :
+			entry = self.values.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0, 0])
+			entry[0][bisect.bisect_left(self.buckets, value)] += 1
+			entry[1] += value
+			entry[2] += 1
+
+	def render(self) -> List[str] :
+		lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} histogram']
+		for label_values, (counts, total, count) in sorted(self.values.items()) :
+			cumulative = 0
+			for bound, n in zip(self.buckets + ['+Inf'], counts) :
+				cumulative += n
+				le = f'le="{bound}"'
+				lines.append(f'{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}')
+			lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total}')
+			lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {count}')
+		return lines
+
+class Registry(object) :
+	def __init__(self) :
+		self.metrics = []
+
+	def add(self, metric) :
+		self.metrics.append(metric)
+		return metric
+
+	def render(self) -> str :
+		"""Prometheus text exposition format."""
+		lines = []
+		for metric in self.metrics :
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,33 @@
+import threading
+import time
+from typing import Callable, Dict, List
+
+# name -> function loading the model into its package
+LOADERS: Dict[str, Callable] = {}
+# name -> seconds it took to load
+LOAD_TIMES: Dict[str, float] = {}
+_LOCK = threading.Lock()
+
+def register_model(name: str, loader: Callable) :
+	LOADERS[name] = loader
+
+def is_loaded(name: str) -> bool :
+	return name in LOAD_TIMES
+
+def ensure_loaded(name: str) :
+	"""Load model `name` the first time it is needed, later calls return immediately."""
+	if name in LOAD_TIMES :
+		return
+	with _LOCK :
+		if name in LOAD_TIMES :
+			return
+		if name not in LOADERS :
+			raise Exception(f'Model {name} is not registered')
+		start = time.perf_counter()
+		LOADERS[name]()
+		LOAD_TIMES[name] = time.perf_counter() - start
+		print(f' -- Loaded model {name} in {LOAD_TIMES[name]:.2f}s')
+
+def preload(names: List[str]) :
+	for name in names :
+		ensure_loaded(name)
@@ -0,0 +1,93 @@
+import asyncio
+import queue
+import threading
+import traceback
+from typing import Callable, Iterable, List, Optional, Tuple
+
+_END = object()
+
+class PipelineExecutor(object) :
+	"""Run pages through a chain of stages, one thread per stage.
+
+	Stages are connected by bounded queues, so while page N is inpainting page N + 1
+	can already be in detection and page N - 1 in rendering. Each stage is an async
+	function taking the page context, it runs on an event loop owned by its thread.
+	A stage given as `(name, function, batch_size)` instead receives a list of up to
+	`batch_size` contexts, made of whatever pages are already waiting for it.
+	A stage can set `ctx['done']` to skip all later stages for that page.
+	`on_loop_exit` is awaited on every stage loop before it is closed.
+	"""
+	def __init__(self, stages: List[Tuple], queue_size: int = 2, on_loop_exit: Optional[Callable] = None) :
+		self.stages = [(s[0], s[1], s[2] if len(s) > 2 else 0) for s in stages]
+		self.queue_size = max(1, queue_size)
+		self.on_loop_exit = on_loop_exit
+
+	def _feed(self, items: Iterable[dict], out_q: queue.Queue) :
+		try :
+			for ctx in items :
+				if ctx is not None :
+					out_q.put(ctx)
+		except Exception :
+			traceback.print_exc()
+		finally :
+			out_q.put(_END)
+
+	def _run_stage(self, name: str, stage: Callable, batch_size: int, in_q: queue.Queue, out_q: queue.Queue) :
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try :
+			finished = False
+			while not finished :
+				ctxs = [in_q.get()]
+				while len(ctxs) < max(1, batch_size) and ctxs[-1] is not _END :
+					try :
+						ctxs.append(in_q.get_nowait())
+					except queue.Empty :
+						break
+				if ctxs[-1] is _END :
+					ctxs.pop()
+					finished = True
+				active = [ctx for ctx in ctxs if not ctx.get('done') and ctx.get('error') is None]
+				if active :
+					try :
+						if batch_size > 0 :
+							loop.run_until_complete(stage(active))
+						else :
+							loop.run_until_complete(stage(active[0]))
+					except Exception as ex :
+						traceback.print_exc()
+						print(f' -- Stage {name} failed')
+						for ctx in active :
+							ctx['error'] = ex
+				for ctx in ctxs :
+					out_q.put(ctx)
+		finally :
+			out_q.put(_END)
+			if self.on_loop_exit is not None :
+				try :
+					loop.run_until_complete(self.on_loop_exit())
+				except Exception :
+					traceback.print_exc()
+			loop.close()
+
+	def run(self, items: Iterable[dict], on_complete: Optional[Callable] = None) :
+		"""Push every context yielded by `items` through all stages, blocking until the last one leaves.
+
+		`on_complete` is called from the calling thread with each finished context, in input order.
+		"""
+		# a batched stage needs room for a whole batch in front of it
+		queues = [queue.Queue(maxsize = max(self.queue_size, batch_size)) for (_, _, batch_size) in self.stages]
+		queues.append(queue.Queue(maxsize = self.queue_size))
+		threads = [threading.Thread(target = self._feed, args = (items, queues[0]), daemon = True)]
+		for i, (name, stage, batch_size) in enumerate(self.stages) :
+			threads.append(threading.Thread(target = self._run_stage, args = (name, stage, batch_size, queues[i], queues[i + 1]), name = f'pipeline-{name}', daemon = True))
+		for t in threads :
+			t.start()
+		while True :
+			ctx = queues[-1].get()
+			if ctx is _END :
+				break
+			if on_complete is not None :
+				on_complete(ctx)
+		for t in threads :
+			t.join()
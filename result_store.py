@@ -0,0 +1,85 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Iterable, List
+
+def directory_size(path: str) -> int :
+	total = 0
+	for root, _, files in os.walk(path) :
+		for f in files :
+			try :
+				total += os.path.getsize(os.path.join(root, f))
+			except OSError :
+				pass
+	return total
+
+class ResultStore(object) :
+	"""Size bounded index of the task directories under `directory`.
+
+	The modification time of a task directory is used as its last access time so
+	the order survives restarts. Once the total size goes over `max_size` bytes
+	`evict` removes the least recently used directories.
+	"""
+	def __init__(self, directory: str, max_size: int) :
+		self.directory = directory
+		self.max_size = max_size
+		self.evictions = 0
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()
+		self._total_size = 0
+		os.makedirs(directory, exist_ok = True)
+		dirs = []
+		for name in os.listdir(directory) :
+			path = os.path.join(directory, name)
+			if not os.path.isdir(path) :
+				continue
+			try :
+				dirs.append((os.stat(path).st_mtime, name, directory_size(path)))
+			except OSError :
+				continue
+		for _, task_id, size in sorted(dirs) :
+			self._entries[task_id] = size
+			self._total_size += size
+
+	@property
+	def total_size(self) -> int :
+		return self._total_size
+
+	def _path(self, task_id: str) -> str :
+		return os.path.join(self.directory, task_id)
+
+	def touch(self, task_id: str) :
+		with self._lock :
+			if task_id in self._entries :
+				self._entries.move_to_end(task_id)
+		try :
+			os.utime(self._path(task_id))
+		except OSError :
+			pass
+
+	def add(self, task_id: str) :
+		"""Index or re-measure a task directory once its files are written."""
+		size = directory_size(self._path(task_id))
+		with self._lock :
+			self._total_size -= self._entries.pop(task_id, 0)
+			self._entries[task_id] = size
+			self._total_size += size
+		self.touch(task_id)
+
+	def evict(self, active: Iterable[str] = ()) -> List[str] :
+		"""Remove least recently used directories until under `max_size`, never those in `active`."""
+		active = set(active)
+		removed = []
+		with self._lock :
+			for task_id in list(self._entries) :
+				if self._total_size <= self.max_size :
+					break
+				if task_id in active :
+					continue
+				self._total_size -= self._entries.pop(task_id)
+				removed.append(task_id)
+			self.evictions += len(removed)
+		for task_id in removed :
+			shutil.rmtree(self._path(task_id), ignore_errors = True)
+		return removed
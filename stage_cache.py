@@ -0,0 +1,96 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def image_hash(img: np.ndarray) -> str :
+	h = hashlib.sha256()
+	h.update(repr((img.shape, str(img.dtype))).encode('utf-8'))
+	h.update(np.ascontiguousarray(img).data)
+	return h.hexdigest()
+
+def make_key(*parts) -> str :
+	return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+class StageCache(object) :
+	"""Content addressed on-disk cache of intermediate pipeline results.
+
+	Every entry is a pickle file named after its key. The file modification time is
+	used as the last access time, once the total size goes over `max_size` bytes the
+	least recently used entries are removed.
+	"""
+	def __init__(self, directory: str, max_size: int) :
+		self.directory = directory
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()
+		self._total_size = 0
+		os.makedirs(directory, exist_ok = True)
+		files = []
+		for name in os.listdir(directory) :
+			if not name.endswith('.pkl') :
+				continue
+			try :
+				st = os.stat(os.path.join(directory, name))
+			except OSError :
+				continue
+			files.append((st.st_mtime, name[: -4], st.st_size))
+		for _, key, size in sorted(files) :
+			self._entries[key] = size
+			self._total_size += size
+		self._evict()
+
+	def _path(self, key: str) -> str :
+		return os.path.join(self.directory, key + '.pkl')
+
+	def get(self, key: str) :
+		with self._lock :
+			if key not in self._entries :
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+		try :
+			with open(self._path(key), 'rb') as fp :
+				value = pickle.load(fp)
+			os.utime(self._path(key))
+		except Exception :
+			# removed by another process or truncated
+			with self._lock :
+				self._drop(key)
+				self.misses += 1
+			return None
+		with self._lock :
+			self.hits += 1
+		return value
+
+	def put(self, key: str, value) :
+		data = pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL)
+		if len(data) > self.max_size :
+			return
+		path = self._path(key)
+		tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+		with open(tmp_path, 'wb') as fp :
+			fp.write(data)
+		os.replace(tmp_path, path)
+		with self._lock :
+			self._total_size -= self._entries.pop(key, 0)
+			self._entries[key] = len(data)
+			self._total_size += len(data)
+			self._evict()
+
+	def _drop(self, key: str) :
+		if key in self._entries :
+			self._total_size -= self._entries.pop(key)
+		try :
+			os.remove(self._path(key))
+		except OSError :
+			pass
+
+	def _evict(self) :
+		while self._total_size > self.max_size and self._entries :
+			self._drop(next(iter(self._entries)))
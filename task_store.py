@@ -0,0 +1,55 @@
+import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+# task options worth keeping across restarts, results and traces are on disk already
+PERSISTED_KEYS = ['size', 'translator', 'tgt', 'detector', 'direction', 'manual', 'created_at']
+
+class TaskStore(object) :
+	"""SQLite record of web tasks and their states.
+
+	The in-memory task tables stay authoritative while serving, every change is
+	mirrored here from a single writer thread so the event loop never waits on
+	disk and writes land in order. `load` is used at startup to recover tasks.
+	"""
+	def __init__(self, path: str) :
+		self.path = path
+		os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+		self._db = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+		self._lock = threading.Lock()
+		self._writer = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'task-store')
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.execute('CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, state TEXT NOT NULL, data TEXT NOT NULL, created_at REAL NOT NULL)')
+		self._db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)')
+		self._db.execute('CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at)')
+
+	def _execute(self, sql: str, params: tuple) :
+		with self._lock :
+			self._db.execute(sql, params)
+
+	def _submit(self, sql: str, params: tuple) :
+		self._writer.submit(self._execute, sql, params)
+
+	def put(self, task_id: str, state: str, data: dict) :
+		options = {k: data[k] for k in PERSISTED_KEYS if k in data}
+		self._submit('INSERT OR REPLACE INTO tasks (task_id, state, data, created_at) VALUES (?, ?, ?, ?)', (task_id, state, json.dumps(options), options.get('created_at', 0)))
+
+	def set_state(self, task_id: str, state: str) :
+		self._submit('UPDATE tasks SET state = ? WHERE task_id = ?', (state, task_id))
+
+	def remove(self, task_id: str) :
+		self._submit('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+	def load(self) -> List[Tuple[str, str, dict]] :
+		"""All tasks as (task_id, state, data), oldest first."""
+		with self._lock :
+			rows = self._db.execute('SELECT task_id, state, data FROM tasks ORDER BY created_at').fetchall()
+		return [(task_id, state, json.loads(data)) for (task_id, state, data) in rows]
+
+	def close(self) :
+		self._writer.shutdown(wait = True)
+		self._db.close()
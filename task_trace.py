@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import List
+
+try :
+	import psutil
+except ImportError : # only needed where /proc is missing
+	psutil = None
+
+# most recent traces of this process, newest last
+RECENT_TRACES = deque(maxlen = 256)
+# seconds between RSS samples while a stage is running
+SAMPLE_INTERVAL = 0.01
+PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') // 1024 if hasattr(os, 'sysconf') else 4
+
+def current_rss_kb() -> int :
+	"""Resident set size right now, 0 where it cannot be read."""
+	try :
+		with open('/proc/self/statm') as fp :
+			return int(fp.read().split()[1]) * PAGE_SIZE_KB
+	except (OSError, ValueError, IndexError) :
+		pass
+	if psutil is not None :
+		return psutil.Process().memory_info().rss // 1024
+	return 0
+
+class RssSampler(object) :
+	"""Samples the current RSS every `interval` seconds and keeps the highest value per open window.
+
+	Unlike ru_maxrss, which never goes down, this gives the peak of one stage.
+	The thread only runs while a window is open, spikes shorter than `interval` can be missed.
+	"""
+	def __init__(self, interval: float) :
+		self.interval = interval
+		# window id -> highest RSS seen since it was opened
+		self._windows = {}
+		self._next_id = 0
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def open(self) -> int :
+		rss = current_rss_kb()
+		with self._lock :
+			window = self._next_id
+			self._next_id += 1
+			self._windows[window] = rss
+			if self._thread is None or not self._thread.is_alive() :
+				self._thread = threading.Thread(target = self._run, name = 'rss-sampler', daemon = True)
+				self._thread.start()
+		return window
+
+	def close(self, window: int) -> int :
+		"""Close a window, returns the highest RSS seen while it was open."""
+		rss = current_rss_kb()
+		with self._lock :
+			return max(self._windows.pop(window), rss)
+
+	def _run(self) :
+		while True :
+			time.sleep(self.interval)
+			rss = current_rss_kb()
+			with self._lock :
+				if not self._windows :
+					self._thread = None
+					return
+				for window, peak in self._windows.items() :
+					if rss > peak :
+						self._windows[window] = rss
+
+RSS_SAMPLER = RssSampler(SAMPLE_INTERVAL)
+
+@contextmanager
+def batch_stage(traces: List['TaskTrace'], name: str) :
+	"""Record a block shared by several pages, like a batched forward pass.
+
+	Every page gets one record with an equal share of the wall and CPU time and
+	a `batch_size` field, so per-page times are not inflated by the batch.
+	"""
+	measured = TaskTrace('', 0, 0)
+	try :
+		with measured.stage(name) :
+			yield
+	finally :
+		record = measured.stages[0]
+		for trace in traces :
+			trace.stages.append({
+				**record,
+				'wall': round(record['wall'] / len(traces), 4),
+				'cpu': round(record['cpu'] / len(traces), 4),
+				'batch_size': len(traces)
+			})
+
+class TaskTrace(object) :
+	def __init__(self, task_id: str, width: int, height: int, source: str = '') :
+		self.task_id = task_id
+		self.source = source
+		self.width = width
+		self.height = height
+		self.num_regions = 0
+		self.created_at = time.time()
+		self.stages = []
+
+	@contextmanager
+	def stage(self, name: str) :
+		"""Record wall time, CPU time, peak RSS and peak RSS growth of the enclosed block.
+
+		CPU time and RSS are process wide so they include torch worker threads, in
+		pipelined batch mode they also include whatever the other stages did meanwhile.
+		"""
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		rss = current_rss_kb()
+		window = RSS_SAMPLER.open()
+		try :
+			yield
+		finally :
+			peak = RSS_SAMPLER.close(window)
+			self.stages.append({
+				'stage': name,
+				'wall': round(time.perf_counter() - wall, 4),
+				'cpu': round(time.process_time() - cpu, 4),
+				'peak_rss_kb': peak,
+				'peak_rss_delta_kb': peak - rss
+			})
+
+	def to_dict(self) -> dict :
+		return {
+			'task_id': self.task_id,
+			'source': self.source,
+			'width': self.width,
+			'height': self.height,
+			'num_regions': self.num_regions,
+			'created_at': self.created_at,
+			'total_wall': round(sum(s['wall'] for s in self.stages), 4),
+			'stages': self.stages
+		}
+
+	def save(self, directory: str) :
+		data = self.to_dict()
+		RECENT_TRACES.append(data)
+		os.makedirs(directory, exist_ok = True)
+		with open(os.path.join(directory, 'trace.jsonl'), 'a', encoding = 'utf-8') as fp :
+			fp.write(json.dumps(data) + '\n')
+		return data
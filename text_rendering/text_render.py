@@ -12,6 +12,7 @@ import unicodedata
 import freetype
 from utils import BBox, Quadrilateral
 import math
+import threading
 
 def _is_whitespace(ch):
 	"""Checks whether `chars` is a whitespace character."""
@@ -188,6 +189,8 @@ def add_color(bw_char_map, color, stroke_char_map, stroke_color) :
 	return bg#, alpha_char_map
 
 CACHED_FONT_FACE = []
+# the faces keep the current pixel size and loaded glyph, workers rendering at the same time must take turns
+FONT_FACE_LOCK = threading.Lock()
 
 import functools
 import copy
@@ -217,43 +220,46 @@ class Glyph :
 @functools.lru_cache(maxsize = 1024, typed = True)
 def get_char_glyph(cdpt, font_size: int, direction: int) :
 	global CACHED_FONT_FACE
-	for i, face in enumerate(CACHED_FONT_FACE) :
-		if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
-			continue
-		if direction == 0 :
-			face.set_pixel_sizes( 0, font_size )
-		elif direction == 1 :
-			face.set_pixel_sizes( font_size, 0 )
-		face.load_char(cdpt)
-		return Glyph(face.glyph)
+	with FONT_FACE_LOCK :
+		for i, face in enumerate(CACHED_FONT_FACE) :
+			if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
+				continue
+			if direction == 0 :
+				face.set_pixel_sizes( 0, font_size )
+			elif direction == 1 :
+				face.set_pixel_sizes( font_size, 0 )
+			face.load_char(cdpt)
+			return Glyph(face.glyph)
 
 #@functools.lru_cache(maxsize = 1024, typed = True)
 def get_char_border(cdpt, font_size: int, direction: int) :
 	global CACHED_FONT_FACE
-	for i, face in enumerate(CACHED_FONT_FACE) :
-		if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
-			continue
-		if direction == 0 :
-			face.set_pixel_sizes( 0, font_size )
-		elif direction == 1 :
-			face.set_pixel_sizes( font_size, 0 )
-		face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
-		slot_border = face.glyph
-		return slot_border.get_glyph()
+	with FONT_FACE_LOCK :
+		for i, face in enumerate(CACHED_FONT_FACE) :
+			if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
+				continue
+			if direction == 0 :
+				face.set_pixel_sizes( 0, font_size )
+			elif direction == 1 :
+				face.set_pixel_sizes( font_size, 0 )
+			face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+			slot_border = face.glyph
+			return slot_border.get_glyph()
 
 def get_char_kerning(cdpt, prev, font_size: int, direction: int) :
 	global CACHED_FONT_FACE
-	for i, face in enumerate(CACHED_FONT_FACE) :
-		if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
-			continue
-		if direction == 0 :
-			face.set_pixel_sizes( 0, font_size )
-		elif direction == 1 :
-			face.set_pixel_sizes( font_size, 0 )
-		face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
-		#print("VV", prev, cdpt, face.get_char_index(prev), face.get_char_index(cdpt))
-		print("VR", face.has_kerning)
-		return face.get_kerning(face.get_char_index(prev), face.get_char_index(cdpt))
+	with FONT_FACE_LOCK :
+		for i, face in enumerate(CACHED_FONT_FACE) :
+			if face.get_char_index(cdpt) == 0 and i != len(CACHED_FONT_FACE) - 1 :
+				continue
+			if direction == 0 :
+				face.set_pixel_sizes( 0, font_size )
+			elif direction == 1 :
+				face.set_pixel_sizes( font_size, 0 )
+			face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+			#print("VV", prev, cdpt, face.get_char_index(prev), face.get_char_index(cdpt))
+			print("VR", face.has_kerning)
+			return face.get_kerning(face.get_char_index(prev), face.get_char_index(cdpt))
 
 def get_font(font_size: int, direction=0) :
 	font_filenames = ['fonts/Arial-Unicode-Regular.ttf', 'fonts/msyh.ttc', 'fonts/msgothic.ttc']
@@ -7,7 +7,7 @@ import cv2
 import torch
 from pathlib import Path
 import torch
-from typing import Union
+from typing import List, Union
 from .utils.yolov5_utils import non_max_suppression
 from .utils.db_utils import SegDetectorRepresenter
 from .utils.io_utils import imread, imwrite, find_all_imgs, NumpyEncoder
@@ -87,11 +87,31 @@ class TextDetector:
     @torch.no_grad()
     def __call__(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, bgr2rgb=True):
         img_in, ratio, dw, dh = preprocess_img(img, input_size=self.input_size, device=self.device, half=self.half, to_tensor=self.backend=='torch')
+        blks, mask, lines_map = self.net(img_in)
+        return self.postprocess(img, blks, mask, lines_map, dw, dh, refine_mode, keep_undetected_mask)
+
+    @torch.no_grad()
+    def batch(self, imgs, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, bgr2rgb=True, max_batch_size=4):
+        """Detect text in several images, sharing forward passes on the torch backend.
 
+        All images are letterboxed to `input_size`, so any of them can be batched together.
+        """
+        if self.backend != 'torch':
+            # the exported onnx graph has a fixed batch size of 1
+            return [self(img, refine_mode, keep_undetected_mask, bgr2rgb) for img in imgs]
+        results = []
+        for i in range(0, len(imgs), max_batch_size):
+            chunk = imgs[i: i + max_batch_size]
+            prepared = [preprocess_img(img, input_size=self.input_size, device=self.device, half=self.half) for img in chunk]
+            blks, mask, lines_map = self.net(torch.cat([p[0] for p in prepared]))
+            for j, img in enumerate(chunk):
+                _, _, dw, dh = prepared[j]
+                results.append(self.postprocess(img, blks[j: j + 1], mask[j: j + 1], lines_map[j: j + 1], dw, dh, refine_mode, keep_undetected_mask))
+        return results
+
+    def postprocess(self, img, blks, mask, lines_map, dw, dh, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
         im_h, im_w = img.shape[:2]
 
-        blks, mask, lines_map = self.net(img_in)
-        
         resize_ratio = (im_w / (self.input_size[0] - dw), im_h / (self.input_size[1] - dh))
         blks = postprocess_yolo(blks, self.conf_thresh, self.nms_thresh, resize_ratio)
         mask = postprocess_mask(mask)
@@ -132,4 +152,10 @@ async def dispatch(img: np.ndarray, cuda: bool):
     global DEFAULT_MODEL
     if DEFAULT_MODEL is None :
         load_model(cuda)
-    return DEFAULT_MODEL(img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, bgr2rgb=False)
\ No newline at end of file
+    return DEFAULT_MODEL(img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, bgr2rgb=False)
+
+async def dispatch_batch(imgs: List[np.ndarray], cuda: bool, max_batch_size: int = 4):
+    global DEFAULT_MODEL
+    if DEFAULT_MODEL is None :
+        load_model(cuda)
+    return DEFAULT_MODEL.batch(imgs, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, bgr2rgb=False, max_batch_size=max_batch_size)
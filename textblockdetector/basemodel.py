@@ -10,6 +10,7 @@ from .utils.weight_init import init_weights
 from .yolov5.common import C3, Conv
 # from torchsummary import summary
 import copy
+import threading
 
 TEXTDET_MASK = 0
 TEXTDET_DET = 1
@@ -245,9 +246,12 @@ class TextDetBaseDNN:
         self.input_size = input_size
         self.model = cv2.dnn.readNetFromONNX(model_path)
         self.uoln = self.model.getUnconnectedOutLayersNames()
+        # setInput and forward share state in the net, web workers must not interleave them
+        self.lock = threading.Lock()
     
     def __call__(self, im_in):
         blob = cv2.dnn.blobFromImage(im_in, scalefactor=1 / 255.0, size=(self.input_size, self.input_size))
-        self.model.setInput(blob)
-        blks, mask, lines_map  = self.model.forward(self.uoln)
+        with self.lock:
+            self.model.setInput(blob)
+            blks, mask, lines_map  = self.model.forward(self.uoln)
         return blks, mask, lines_map
\ No newline at end of file
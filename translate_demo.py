@@ -4,29 +4,35 @@ import argparse
 from PIL import Image
 import cv2
 import numpy as np
-import requests
+import threading
 import os
-from oscrypto import util as crypto_utils
+import sys
 import asyncio
 
-from detection import dispatch as dispatch_detection, load_model as load_detection_model
+from detection import dispatch as dispatch_detection, dispatch_batch as dispatch_detection_batch, load_model as load_detection_model
 from ocr import dispatch as dispatch_ocr, load_model as load_ocr_model
 from inpainting import dispatch as dispatch_inpainting, load_model as load_inpainting_model
 from text_mask import dispatch as dispatch_mask_refinement
 from textline_merge import dispatch as dispatch_textline_merge
 from text_rendering import dispatch as dispatch_rendering, text_render
-from textblockdetector import dispatch as dispatch_ctd_detection
+from textblockdetector import dispatch as dispatch_ctd_detection, dispatch_batch as dispatch_ctd_detection_batch, load_model as load_ctd_model
 from textblockdetector.textblock import visualize_textblocks
 from utils import convert_img
+from pipeline import PipelineExecutor
+from image_io import prefetch, AsyncImageWriter
+from task_trace import TaskTrace, batch_stage
+from batch_manifest import BatchManifest, MANIFEST_NAME, file_hash
+from stage_cache import StageCache, image_hash, make_key
+from model_registry import register_model, ensure_loaded, preload as preload_models
 
 parser = argparse.ArgumentParser(description='Generate text bboxes given a image file')
-parser.add_argument('--mode', default='demo', type=str, help='Run demo in either single image demo mode (demo), web service mode (web) or batch translation mode (batch)')
+parser.add_argument('--mode', default='demo', type=str, help='Run demo in either single image demo mode (demo), web service mode (web), batch translation mode (batch) or benchmark mode (bench)')
 parser.add_argument('--image', default='', type=str, help='Image file if using demo mode or Image folder name if using batch mode')
 parser.add_argument('--image-dst', default='', type=str, help='Destination folder for translated images in batch mode')
 parser.add_argument('--size', default=1536, type=int, help='image square size')
 parser.add_argument('--host', default='127.0.0.1', type=str, help='Used by web module to decide which host to attach to')
 parser.add_argument('--port', default=5003, type=int, help='Used by web module to decide which port to attach to')
-parser.add_argument('--log-web', action='store_true', help='Used by web module to decide if web logs should be surfaced')
+parser.add_argument('--log-web', action='store_true', help='Kept for compatibility, the web server now runs in the same process and always logs')
 parser.add_argument('--ocr-model', default='48px_ctc', type=str, help='OCR model to use, one of `32px`, `48px_ctc`')
 parser.add_argument('--use-inpainting', action='store_true', help='turn on/off inpainting')
 parser.add_argument('--inpainting-model', default='lama_mpe', type=str, help='inpainting model to use, one of `lama_mpe`')
@@ -44,33 +50,50 @@ parser.add_argument('--use-ctd', action='store_true', help='use comic-text-detec
 parser.add_argument('--verbose', action='store_true', help='print debug info and save intermediate images')
 parser.add_argument('--manga2eng', action='store_true', help='render English text translated from manga with some typesetting')
 parser.add_argument('--eng-font', default='fonts/comic shanns 2.ttf', type=str, help='font used by manga2eng mode')
+parser.add_argument('--pipeline-queue-size', default=2, type=int, help='number of pages buffered between pipeline stages in batch mode')
+parser.add_argument('--detection-batch-size', default=4, type=int, help='maximum number of pages sharing one detection forward pass in batch mode')
+parser.add_argument('--io-workers', default=2, type=int, help='number of threads decoding and writing images in batch mode')
+parser.add_argument('--prefetch-size', default=4, type=int, help='number of pages decoded ahead of detection in batch mode')
+parser.add_argument('--workers', default=1, type=int, help='number of worker processes in batch mode or inference threads in web mode, models are loaded once and shared between them')
+parser.add_argument('--stage-cache-size', default=0, type=int, help='size limit in MB of the on-disk cache of detection, OCR and inpainting results, 0 disables it')
+parser.add_argument('--result-cache-size', default=0, type=int, help='size limit in MB of the `result/` directory in web mode, least recently used results are removed past it, 0 keeps everything')
+parser.add_argument('--task-db', default='result/tasks.db', type=str, help='SQLite file recording web tasks so queued work survives a restart, empty keeps tasks in memory only')
+parser.add_argument('--max-queue-size', default=0, type=int, help='in web mode new tasks are refused with HTTP 429 while this many are waiting, 0 for no limit')
+parser.add_argument('--translator-failover', default='google', type=str, help='comma separated translators tried in order when --translator (or the one of a web task) fails')
+parser.add_argument('--translator-rate-limits', default='', type=str, help='per translator limits as name=requests_per_second:chars_per_second, comma separated, 0 for no limit, e.g. google=5:10000,baidu=1:2000')
+parser.add_argument('--translation-cache', default='cache/translations.db', type=str, help='SQLite file remembering machine translations of every line, empty disables it')
+parser.add_argument('--stage-cache-dir', default='cache', type=str, help='directory of the on-disk cache of intermediate results')
+parser.add_argument('--bench-pages', default=8, type=int, help='number of measured synthetic pages per configuration in bench mode')
+parser.add_argument('--bench-warmup', default=2, type=int, help='number of synthetic pages run before measuring in bench mode')
+parser.add_argument('--bench-sizes', default='1024x1536', type=str, help='comma separated synthetic page sizes in bench mode, e.g. `1024x1536,2048x3072`')
+parser.add_argument('--bench-bubbles', default=6, type=int, help='number of speech bubbles per synthetic page in bench mode')
+parser.add_argument('--bench-script', default='cjk', type=str, help='script of the synthetic text in bench mode, one of `cjk`, `latin`')
+parser.add_argument('--bench-seed', default=0, type=int, help='seed of the synthetic page generator in bench mode')
+parser.add_argument('--bench-detectors', default='', type=str, help='comma separated detectors to benchmark, defaults to the configured one')
+parser.add_argument('--bench-ocr-models', default='', type=str, help='comma separated OCR models to benchmark, defaults to the configured one')
+parser.add_argument('--bench-inpainting-models', default='', type=str, help='comma separated inpainting models to benchmark, defaults to the configured one, only used with --use-inpainting')
+parser.add_argument('--bench-output', default='result/bench/report.json', type=str, help='where bench mode writes its JSON report')
 args = parser.parse_args()
 
-def update_state(task_id, nonce, state) :
-	while True :
-		try :
-			requests.post(f'http://{args.host}:{args.port}/task-update-internal', json = {'task_id': task_id, 'nonce': nonce, 'state': state}, timeout = 20)
-			return
-		except Exception :
-			if 'error' in state or 'finished' in state :
-				continue
-			else :
-				break
+OCR_MODEL_NAMES = ['32px', '48px_ctc']
+INPAINTING_MODEL_NAMES = ['default', 'lama', 'lama_mpe']
 
-def get_task(nonce) :
-	try :
-		rjson = requests.get(f'http://{args.host}:{args.port}/task-internal?nonce={nonce}', timeout = 3600).json()
-		if 'task_id' in rjson and 'data' in rjson :
-			return rjson['task_id'], rjson['data']
-		else :
-			return None, None
-	except Exception :
-		return None, None
+STAGE_CACHE = None
 
-async def infer(
+# event loop of the in-process web server, see `main`
+WEB_LOOP = None
+
+def update_state(task_id, state, trace = None) :
+	import web_main
+	WEB_LOOP.call_soon_threadsafe(web_main.update_task_state, task_id, state, trace)
+
+async def call_web_async(coro) :
+	"""Run a coroutine of `web_main` on the web server loop and wait for its result from the worker loop."""
+	return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, WEB_LOOP))
+
+def build_context(
 	img,
 	mode,
-	nonce,
 	options = None,
 	task_id = '',
 	dst_image_name = '',
@@ -98,18 +121,117 @@ async def infer(
 		if options['direction'] == 'horizontal' :
 			render_text_direction_overwrite = 'h'
 	print(f' -- Render text direction is {render_text_direction_overwrite or "auto"}')
+	cache_keys = {}
+	if STAGE_CACHE is not None :
+		# intermediate results only depend on the image and model settings, not on the translator or target language
+		if detector == 'ctd' :
+			cache_keys['detection'] = make_key('detection', image_hash(img), detector)
+		else :
+			cache_keys['detection'] = make_key('detection', image_hash(img), detector, img_detect_size, args.text_threshold, args.box_threshold, args.unclip_ratio)
+		cache_keys['ocr'] = make_key('ocr', cache_keys['detection'], args.ocr_model)
+		cache_keys['inpainting'] = make_key('inpainting', cache_keys['ocr'], args.use_inpainting, args.inpainting_model, args.inpainting_size)
+	return {
+		'img': img,
+		'mode': mode,
+		'options': options,
+		'task_id': task_id,
+		'dst_image_name': dst_image_name,
+		'alpha_ch': alpha_ch,
+		'detect_size': img_detect_size,
+		'detector': detector,
+		'direction': render_text_direction_overwrite,
+		'cache_keys': cache_keys,
+		'trace': TaskTrace(task_id, img.shape[1], img.shape[0], source = dst_image_name),
+		'done': False,
+		'error': None
+	}
 
-	if mode == 'web' and task_id :
-		update_state(task_id, nonce, 'detection')
-	
-	if detector == 'ctd' :
-		mask, final_mask, textlines = await dispatch_ctd_detection(img, args.use_cuda)
-		text_regions = textlines
-	else:
-		textlines, mask = await dispatch_detection(img, img_detect_size, args.use_cuda, args, verbose = args.verbose)
+def cache_get(ctx, stage: str) :
+	if STAGE_CACHE is None :
+		return None
+	return STAGE_CACHE.get(ctx['cache_keys'][stage])
+
+def cache_put(ctx, stage: str, value) :
+	if STAGE_CACHE is not None :
+		STAGE_CACHE.put(ctx['cache_keys'][stage], value)
+
+def finish_trace(ctx) :
+	if ctx.get('trace_data') is None :
+		ctx['trace_data'] = ctx['trace'].save(f'result/{ctx["task_id"]}')
+	return ctx['trace_data']
+
+async def run_detection_stage(ctx) :
+	await run_detection_batch_stage([ctx])
+
+async def run_detection_batch_stage(ctxs) :
+	to_detect = []
+	for ctx in ctxs :
+		if ctx['mode'] == 'web' and ctx['task_id'] :
+			update_state(ctx['task_id'], 'detection')
+		# when OCR results are cached detection can be skipped altogether
+		ctx['cached_ocr'] = cache_get(ctx, 'ocr')
+		if ctx['cached_ocr'] is not None :
+			continue
+		cached = cache_get(ctx, 'detection')
+		if cached is not None :
+			ctx['textlines'], ctx['mask'], ctx['final_mask'] = cached
+			continue
+		to_detect.append(ctx)
+
+	ctd_ctxs = [ctx for ctx in to_detect if ctx['detector'] == 'ctd']
+	if ctd_ctxs :
+		ensure_loaded('ctd')
+		await detect_group(
+			ctd_ctxs,
+			lambda ctx: dispatch_ctd_detection(ctx['img'], args.use_cuda),
+			lambda ctxs: dispatch_ctd_detection_batch([ctx['img'] for ctx in ctxs], args.use_cuda, args.detection_batch_size),
+			lambda ctx, result: finish_detection(ctx, result[2], result[0], result[1])
+		)
+
+	# default detector pages can only share a forward pass at the same detection size
+	default_ctxs = {}
+	for ctx in to_detect :
+		if ctx['detector'] != 'ctd' :
+			default_ctxs.setdefault(ctx['detect_size'], []).append(ctx)
+	for detect_size, group in default_ctxs.items() :
+		ensure_loaded('detection')
+		await detect_group(
+			group,
+			lambda ctx: dispatch_detection(ctx['img'], detect_size, args.use_cuda, args, verbose = args.verbose),
+			lambda ctxs: dispatch_detection_batch([ctx['img'] for ctx in ctxs], detect_size, args.use_cuda, args, verbose = args.verbose, max_batch_size = args.detection_batch_size),
+			lambda ctx, result: finish_detection(ctx, result[0], result[1], None)
+		)
 
+async def detect_group(ctxs, detect_one, detect_batch, finish) :
+	"""Detect `ctxs` in one batched pass, if the batch fails its pages are retried one at a time.
+
+	A page that still fails gets `ctx['error']` instead of failing its neighbours.
+	"""
+	import traceback
+	results = None
+	if len(ctxs) > 1 :
+		try :
+			with batch_stage([ctx['trace'] for ctx in ctxs], 'detection') :
+				results = await detect_batch(ctxs)
+		except Exception :
+			traceback.print_exc()
+			print(f' -- Batched detection of {len(ctxs)} pages failed, retrying them one at a time')
+	for i, ctx in enumerate(ctxs) :
+		try :
+			if results is not None :
+				result = results[i]
+			else :
+				with ctx['trace'].stage('detection') :
+					result = await detect_one(ctx)
+			finish(ctx, result)
+		except Exception as ex :
+			traceback.print_exc()
+			ctx['error'] = ex
+
+def finish_detection(ctx, textlines, mask, final_mask) :
+	img, task_id = ctx['img'], ctx['task_id']
 	if args.verbose :
-		if detector == 'ctd' :
+		if ctx['detector'] == 'ctd' :
 			bboxes = visualize_textblocks(cv2.cvtColor(img,cv2.COLOR_BGR2RGB), textlines)
 			cv2.imwrite(f'result/{task_id}/bboxes.png', bboxes)
 			cv2.imwrite(f'result/{task_id}/mask_raw.png', mask)
@@ -120,13 +242,36 @@ async def infer(
 				cv2.polylines(img_bbox_raw, [txtln.pts], True, color = (255, 0, 0), thickness = 2)
 			cv2.imwrite(f'result/{task_id}/bbox_unfiltered.png', cv2.cvtColor(img_bbox_raw, cv2.COLOR_RGB2BGR))
 			cv2.imwrite(f'result/{task_id}/mask_raw.png', mask)
+	ctx['textlines'], ctx['mask'], ctx['final_mask'] = textlines, mask, final_mask
+	cache_put(ctx, 'detection', (textlines, mask, final_mask))
+
+async def run_ocr_stage(ctx) :
+	mode, task_id = ctx['mode'], ctx['task_id']
+	if mode == 'web' and task_id :
+		update_state(task_id, 'ocr')
+	if ctx['cached_ocr'] is not None :
+		ctx['textlines'], ctx['text_regions'], ctx['final_mask'] = ctx['cached_ocr']
+	else :
+		await recognize_text(ctx)
+		cache_put(ctx, 'ocr', (ctx['textlines'], ctx['text_regions'], ctx['final_mask']))
+	ctx['trace'].num_regions = len(ctx['text_regions'])
 
 	if mode == 'web' and task_id :
-		update_state(task_id, nonce, 'ocr')
-	textlines = await dispatch_ocr(img, textlines, args.use_cuda, args, model_name = args.ocr_model, verbose = args.verbose)
+		print(' -- Translating')
+		update_state(task_id, 'translating')
+		# in web mode, we can start translation task async
+		import web_main
+		WEB_LOOP.call_soon_threadsafe(web_main.request_translation, task_id, get_region_texts(ctx))
+
+async def recognize_text(ctx) :
+	img, mode, task_id, detector = ctx['img'], ctx['mode'], ctx['task_id'], ctx['detector']
+	ensure_loaded(f'ocr:{args.ocr_model}')
+	with ctx['trace'].stage('ocr') :
+		textlines = await dispatch_ocr(img, ctx['textlines'], args.use_cuda, args, model_name = args.ocr_model, verbose = args.verbose)
 
 	if detector == 'default' :
-		text_regions, textlines = await dispatch_textline_merge(textlines, img.shape[1], img.shape[0], verbose = args.verbose)
+		with ctx['trace'].stage('textline_merge') :
+			text_regions, textlines = await dispatch_textline_merge(textlines, img.shape[1], img.shape[0], verbose = args.verbose)
 		if args.verbose :
 			img_bbox = np.copy(img)
 			for region in text_regions :
@@ -138,99 +283,149 @@ async def infer(
 
 		print(' -- Generating text mask')
 		if mode == 'web' and task_id :
-			update_state(task_id, nonce, 'mask_generation')
+			update_state(task_id, 'mask_generation')
 		# create mask
-		final_mask = await dispatch_mask_refinement(img, mask, textlines)
-
-	if mode == 'web' and task_id :
-		print(' -- Translating')
-		update_state(task_id, nonce, 'translating')
-		# in web mode, we can start translation task async
-		if detector == 'ctd':
-			requests.post(f'http://{args.host}:{args.port}/request-translation-internal', json = {'task_id': task_id, 'nonce': nonce, 'texts': [r.get_text() for r in text_regions]}, timeout = 20)
-		else:
-			requests.post(f'http://{args.host}:{args.port}/request-translation-internal', json = {'task_id': task_id, 'nonce': nonce, 'texts': [r.text for r in text_regions]}, timeout = 20)
+		with ctx['trace'].stage('mask_refinement') :
+			ctx['final_mask'] = await dispatch_mask_refinement(img, ctx['mask'], textlines)
+	else :
+		text_regions = textlines
+	ctx['textlines'], ctx['text_regions'] = textlines, text_regions
 
+async def run_inpainting_stage(ctx) :
+	img, mode, task_id = ctx['img'], ctx['mode'], ctx['task_id']
 	print(' -- Running inpainting')
 	if mode == 'web' and task_id :
-		update_state(task_id, nonce, 'inpainting')
+		update_state(task_id, 'inpainting')
 	# run inpainting
-	if text_regions :
-		img_inpainted = await dispatch_inpainting(args.use_inpainting, False, args.use_cuda, img, final_mask, args.inpainting_size, verbose = args.verbose)
+	if ctx['text_regions'] and args.use_inpainting :
+		img_inpainted = cache_get(ctx, 'inpainting')
+		if img_inpainted is None :
+			ensure_loaded(f'inpainting:{args.inpainting_model}')
+			with ctx['trace'].stage('inpainting') :
+				img_inpainted = await dispatch_inpainting(args.use_inpainting, False, args.use_cuda, img, ctx['final_mask'], args.inpainting_size, model_name = args.inpainting_model, verbose = args.verbose)
+			cache_put(ctx, 'inpainting', img_inpainted)
+	elif ctx['text_regions'] :
+		with ctx['trace'].stage('inpainting') :
+			img_inpainted = await dispatch_inpainting(args.use_inpainting, False, args.use_cuda, img, ctx['final_mask'], args.inpainting_size, model_name = args.inpainting_model, verbose = args.verbose)
 	else :
 		img_inpainted = img
 	if args.verbose :
 		cv2.imwrite(f'result/{task_id}/inpaint_input.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 		cv2.imwrite(f'result/{task_id}/inpainted.png', cv2.cvtColor(img_inpainted, cv2.COLOR_RGB2BGR))
-		cv2.imwrite(f'result/{task_id}/mask_final.png', final_mask)
+		cv2.imwrite(f'result/{task_id}/mask_final.png', ctx['final_mask'])
+	ctx['img_inpainted'] = img_inpainted
+
+def translator_chain(translator: str) :
+	return [translator] + [name for name in split_names(args.translator_failover, translator) if name != translator]
 
+async def run_translation_stage(ctx) :
+	mode, task_id, options = ctx['mode'], ctx['task_id'], ctx['options']
 	# translate text region texts
 	translated_sentences = None
 	print(' -- Translating')
-	if mode != 'web' :
-		# try:
-		from translators import dispatch as run_translation
-		if detector == 'ctd' :
-			translated_sentences = await run_translation(args.translator, 'auto', args.target_lang, [r.get_text() for r in text_regions])
-		else:
-			translated_sentences = await run_translation(args.translator, 'auto', args.target_lang, [r.text for r in text_regions])
-
-	else :
-		# wait for at most 1 hour for manual translation
-		if 'manual' in options and options['manual'] :
-			wait_n_10ms = 36000
+	with ctx['trace'].stage('translation') :
+		if mode == 'bench' :
+			# keep benchmarks offline, the recognized text is rendered back
+			translated_sentences = get_region_texts(ctx)
+		elif mode != 'web' :
+			from translators import dispatch_with_failover
+			translated_sentences = await dispatch_with_failover(translator_chain(args.translator), 'auto', args.target_lang, get_region_texts(ctx))
 		else :
-			wait_n_10ms = 300 # 30 seconds for machine translation
-		for _ in range(wait_n_10ms) :
-			ret = requests.post(f'http://{args.host}:{args.port}/get-translation-result-internal', json = {'task_id': task_id, 'nonce': nonce}, timeout = 20).json()
-			if 'result' in ret :
-				translated_sentences = ret['result']
-				if isinstance(translated_sentences, str) :
-					if translated_sentences == 'error' :
-						update_state(task_id, nonce, 'error-lang')
-						return
-				break
-			await asyncio.sleep(0.01)
-
-	print(' -- Rendering translated text')
+			import web_main
+			# wait for at most 1 hour for manual translation
+			if 'manual' in options and options['manual'] :
+				timeout = 3600
+			else :
+				timeout = 120 # 2 minutes for machine translation, retries and failover included
+			translated_sentences = await call_web_async(web_main.wait_translation_result(task_id, timeout))
+	if isinstance(translated_sentences, str) and translated_sentences == 'error' :
+		update_state(task_id, 'error-lang')
+		ctx['done'] = True
+		return
 	if translated_sentences == None:
 		if mode == 'web' and task_id :
 			print("No text found!")
-			update_state(task_id, nonce, 'error-no-txt')
+			update_state(task_id, 'error-no-txt')
+		ctx['done'] = True
 		return
-	
+	ctx['translated_sentences'] = translated_sentences
+
+async def run_rendering_stage(ctx) :
+	img, mode, task_id, detector = ctx['img'], ctx['mode'], ctx['task_id'], ctx['detector']
+	img_inpainted, translated_sentences, text_regions = ctx['img_inpainted'], ctx['translated_sentences'], ctx['text_regions']
+	render_text_direction_overwrite = ctx['direction']
+	print(' -- Rendering translated text')
 	if mode == 'web' and task_id :
-		update_state(task_id, nonce, 'render')
+		update_state(task_id, 'render')
 	# render translated texts
-	if args.target_lang == 'ENG' and args.manga2eng:
-		from text_rendering import dispatch_eng_render
-		output = await dispatch_eng_render(np.copy(img_inpainted), img, text_regions, translated_sentences, args.eng_font)
-	else:
-		if detector == 'ctd' :
-			from text_rendering import dispatch_ctd_render
-			output = await dispatch_ctd_render(np.copy(img_inpainted), args.text_mag_ratio, translated_sentences, text_regions, render_text_direction_overwrite, args.font_size_offset)
+	with ctx['trace'].stage('rendering') :
+		if args.target_lang == 'ENG' and args.manga2eng:
+			from text_rendering import dispatch_eng_render
+			output = await dispatch_eng_render(np.copy(img_inpainted), img, text_regions, translated_sentences, args.eng_font)
 		else:
-			output = await dispatch_rendering(np.copy(img_inpainted), args.text_mag_ratio, translated_sentences, textlines, text_regions, render_text_direction_overwrite, args.font_size_offset)
+			if detector == 'ctd' :
+				from text_rendering import dispatch_ctd_render
+				output = await dispatch_ctd_render(np.copy(img_inpainted), args.text_mag_ratio, translated_sentences, text_regions, render_text_direction_overwrite, args.font_size_offset)
+			else:
+				output = await dispatch_rendering(np.copy(img_inpainted), args.text_mag_ratio, translated_sentences, ctx['textlines'], text_regions, render_text_direction_overwrite, args.font_size_offset)
 	
 	print(' -- Saving results')
-	if alpha_ch is not None :
-		output = np.concatenate([output.astype(np.uint8), np.array(alpha_ch).astype(np.uint8)[..., None]], axis = 2)
-	else :
-		output = output.astype(np.uint8)
-	img_pil = Image.fromarray(output)
-	if dst_image_name :
-		img_pil.save(dst_image_name)
-	else :
-		img_pil.save(f'result/{task_id}/final.png')
+	with ctx['trace'].stage('saving') :
+		alpha_ch = ctx['alpha_ch']
+		if alpha_ch is not None :
+			output = np.concatenate([output.astype(np.uint8), np.array(alpha_ch).astype(np.uint8)[..., None]], axis = 2)
+		else :
+			output = output.astype(np.uint8)
+		img_pil = Image.fromarray(output)
+		if ctx['dst_image_name'] and ctx.get('image_writer') is not None :
+			# encoded and written in the background, see `run_batch_pipeline`
+			ctx['save_future'] = ctx['image_writer'].save(img_pil, ctx['dst_image_name'])
+		elif ctx['dst_image_name'] :
+			img_pil.save(ctx['dst_image_name'])
+		else :
+			img_pil.save(f'result/{task_id}/final.png')
 
 	if mode == 'web' and task_id :
-		update_state(task_id, nonce, 'finished')
+		update_state(task_id, 'finished', finish_trace(ctx))
+	ctx['done'] = True
+
+def get_region_texts(ctx) :
+	if ctx['detector'] == 'ctd' :
+		return [r.get_text() for r in ctx['text_regions']]
+	return [r.text for r in ctx['text_regions']]
+
+PIPELINE_STAGES = [
+	('detection', run_detection_stage),
+	('ocr', run_ocr_stage),
+	('inpainting', run_inpainting_stage),
+	('translation', run_translation_stage),
+	('rendering', run_rendering_stage),
+]
+
+async def infer(
+	img,
+	mode,
+	options = None,
+	task_id = '',
+	dst_image_name = '',
+	alpha_ch = None
+	) :
+	ctx = build_context(img, mode, options, task_id, dst_image_name, alpha_ch)
+	await run_stages(ctx)
+
+async def run_stages(ctx) :
+	try :
+		for _, stage in PIPELINE_STAGES :
+			await stage(ctx)
+			if ctx['done'] :
+				break
+	finally :
+		finish_trace(ctx)
 
 
 async def infer_safe(
 	img,
 	mode,
-	nonce,
 	options = None,
 	task_id = '',
 	dst_image_name = '',
@@ -240,7 +435,6 @@ async def infer_safe(
 		return await infer(
 			img,
 			mode,
-			nonce,
 			options,
 			task_id,
 			dst_image_name,
@@ -249,24 +443,310 @@ async def infer_safe(
 	except :
 		import traceback
 		traceback.print_exc()
-		update_state(task_id, nonce, 'error')
+		update_state(task_id, 'error')
 
 def replace_prefix(s: str, old: str, new: str) :
 	if s.startswith(old) :
 		s = new + s[len(old):]
 	return s
 
-async def main(mode = 'demo') :
-	print(' -- Loading models')
+def walk_batch_files(src: str, dst: str, manifest: BatchManifest) :
+	for root, subdirs, files in os.walk(src) :
+		if os.path.abspath(root) == os.path.abspath(dst) :
+			continue
+		dst_root = replace_prefix(root, src, dst)
+		os.makedirs(dst_root, exist_ok = True)
+		for f in files :
+			if f.lower() == '.thumb' :
+				continue
+			filename = os.path.join(root, f)
+			src_hash = file_hash(filename)
+			if manifest.is_finished(os.path.relpath(filename, src), src_hash) :
+				print('Skipping finished', filename)
+				continue
+			yield filename, replace_prefix(filename, src, dst), src_hash
+
+def load_batch_page(filename: str, dst_filename: str, src_hash: str) :
+	try :
+		img, alpha_ch = convert_img(Image.open(filename))
+		img = np.array(img)
+	except Exception :
+		return None
+	print('Processing', filename, '->', dst_filename)
+	ctx = build_context(img, 'demo', dst_image_name = dst_filename, alpha_ch = alpha_ch)
+	ctx['src_filename'] = filename
+	ctx['src_hash'] = src_hash
+	return ctx
+
+def run_batch_pipeline(src: str, dst: str, manifest: BatchManifest) :
+	writer = AsyncImageWriter(args.io_workers, args.prefetch_size)
+
+	def load(filename, dst_filename, src_hash) :
+		return filename, dst_filename, src_hash, load_batch_page(filename, dst_filename, src_hash)
+
+	def load_pages() :
+		# pages are decoded ahead of time so detection never waits on image codecs
+		for filename, dst_filename, src_hash, ctx in prefetch(walk_batch_files(src, dst, manifest), load, args.io_workers, args.prefetch_size) :
+			if ctx is None :
+				manifest.mark(os.path.relpath(filename, src), src_hash, 'failed', dst_filename)
+				continue
+			ctx['image_writer'] = writer
+			yield ctx
+
+	def on_complete(ctx) :
+		finish_trace(ctx)
+		status = 'failed' if ctx['error'] is not None else 'finished'
+		if 'save_future' in ctx :
+			try :
+				ctx['save_future'].result()
+			except Exception :
+				import traceback
+				traceback.print_exc()
+				status = 'failed'
+		manifest.mark(os.path.relpath(ctx['src_filename'], src), ctx['src_hash'], status, ctx['dst_image_name'])
+
+	# detection runs over all pages waiting for it in one forward pass
+	stages = [('detection', run_detection_batch_stage, args.detection_batch_size)] + PIPELINE_STAGES[1:]
+	try :
+		PipelineExecutor(stages, args.pipeline_queue_size, on_loop_exit = close_translator_sessions).run(load_pages(), on_complete = on_complete)
+	finally :
+		writer.close()
+
+async def close_translator_sessions() :
+	# nothing to close or flush when no page got translated, and bench mode never imports the translators
+	if 'translators' in sys.modules :
+		from translators import close_sessions, flush_cache
+		await close_sessions()
+		flush_cache()
+
+def run_web_worker(worker_id: int) :
+	# inference blocks whichever event loop it runs on, so every worker gets its own thread and loop
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	loop.run_until_complete(web_worker_loop(worker_id))
+
+async def web_worker_loop(worker_id: int) :
+	import web_main
+	running = set()
+	while True :
+		try :
+			task_id, options = await call_web_async(web_main.wait_for_task(worker_id))
+			print(f' -- Worker {worker_id} processing task {task_id}')
+			# manual translation tasks wait for their translation without blocking the next task
+			infer_task = asyncio.create_task(run_web_task(task_id, options))
+			running.add(infer_task)
+			infer_task.add_done_callback(running.discard)
+		except Exception :
+			import traceback
+			traceback.print_exc()
+
+async def run_web_task(task_id, options) :
+	try :
+		img, alpha_ch = convert_img(Image.open(f'result/{task_id}/input.png'))
+		img = np.array(img)
+	except Exception :
+		import traceback
+		traceback.print_exc()
+		update_state(task_id, 'error')
+		return
+	await infer_safe(img, 'web', options, task_id, alpha_ch = alpha_ch)
+
+def split_names(spec: str, default: str) :
+	return [name.strip() for name in spec.split(',') if name.strip()] or [default]
+
+async def run_benchmark() :
+	import json
+	import time
+	from itertools import product
+	from bench import generate_page, parse_sizes, summarize, format_report
+	sizes = parse_sizes(args.bench_sizes)
+	num_pages = max(0, args.bench_warmup) + max(1, args.bench_pages)
+	print(f' -- Generating {num_pages} synthetic pages')
+	pages = [generate_page(*sizes[i % len(sizes)], args.bench_bubbles, args.bench_script, seed = args.bench_seed + i) for i in range(num_pages)]
+	os.makedirs('result/bench', exist_ok = True)
+	detectors = split_names(args.bench_detectors, 'ctd' if args.use_ctd else 'default')
+	ocr_models = split_names(args.bench_ocr_models, args.ocr_model)
+	inpainting_models = split_names(args.bench_inpainting_models, args.inpainting_model)
+	results = []
+	for detector, ocr_model, inpainting_model in product(detectors, ocr_models, inpainting_models) :
+		print(f' -- Benchmarking detector {detector}, OCR {ocr_model}, inpainting {inpainting_model}')
+		args.ocr_model, args.inpainting_model = ocr_model, inpainting_model
+		traces = []
+		start = time.perf_counter()
+		for i, img in enumerate(pages) :
+			if i == args.bench_warmup :
+				start = time.perf_counter()
+			ctx = build_context(img, 'bench', {'detector': detector}, 'bench', f'result/bench/{i:03d}.png')
+			for _, stage in PIPELINE_STAGES :
+				await stage(ctx)
+				if ctx['done'] :
+					break
+			if i >= args.bench_warmup :
+				traces.append(ctx['trace'].to_dict())
+		results.append({'detector': detector, 'ocr_model': ocr_model, 'inpainting_model': inpainting_model, **summarize(traces, time.perf_counter() - start)})
+	print(format_report(results))
+	report = {
+		'config': {k: v for k, v in vars(args).items() if k.startswith('bench_') or k in ('size', 'use_cuda', 'use_inpainting', 'inpainting_size', 'target_lang')},
+		'results': results
+	}
+	os.makedirs(os.path.dirname(args.bench_output) or '.', exist_ok = True)
+	with open(args.bench_output, 'w', encoding = 'utf-8') as fp :
+		json.dump(report, fp, indent = 2)
+	print(f' -- Benchmark report written to {args.bench_output}')
+
+def register_models() :
+	# models are loaded on first use, see `model_registry.ensure_loaded`
+	def ocr_loader(model_name) :
+		def load() :
+			with open('alphabet-all-v5.txt', 'r', encoding = 'utf-8') as fp :
+				dictionary = [s[:-1] for s in fp.readlines()]
+			load_ocr_model(dictionary, args.use_cuda, model_name)
+		return load
+	for model_name in OCR_MODEL_NAMES :
+		register_model(f'ocr:{model_name}', ocr_loader(model_name))
+	for model_name in INPAINTING_MODEL_NAMES :
+		register_model(f'inpainting:{model_name}', lambda model_name = model_name: load_inpainting_model(args.use_cuda, model_name))
+	register_model('ctd', lambda: load_ctd_model(args.use_cuda))
+	register_model('detection', lambda: load_detection_model(args.use_cuda))
+
+def required_models() :
+	names = ['ctd' if args.use_ctd else 'detection', f'ocr:{args.ocr_model}']
+	if args.use_inpainting :
+		names.append(f'inpainting:{args.inpainting_model}')
+	return names
+
+def batch_worker(worker_id: int, num_threads: int, file_queue, result_queue) :
+	# forked from run_batch() after models are loaded, weights are shared with the parent copy-on-write
+	import torch
+	import traceback
+	torch.set_num_threads(num_threads)
+	cv2.setNumThreads(num_threads)
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	while True :
+		item = file_queue.get()
+		if item is None :
+			break
+		filename, dst_filename, src_hash = item
+		ctx = load_batch_page(filename, dst_filename, src_hash)
+		if ctx is None :
+			result_queue.put((worker_id, filename, 'failed'))
+			continue
+		try :
+			loop.run_until_complete(run_stages(ctx))
+			result_queue.put((worker_id, filename, 'finished'))
+		except Exception :
+			traceback.print_exc()
+			result_queue.put((worker_id, filename, 'failed'))
+	loop.run_until_complete(close_translator_sessions())
+
+def run_batch_workers(src: str, dst: str, num_workers: int, manifest: BatchManifest) :
+	"""Translate the pages in forked worker processes, each worker is handed one page at a time.
+
+	A worker that dies (OOM killer, segfault) only fails the page it was on,
+	the remaining pages go to the workers still alive.
+	"""
+	import queue
+	import multiprocessing
+	mp_ctx = multiprocessing.get_context('fork')
+	items = list(walk_batch_files(src, dst, manifest))
+	num_files = len(items)
+	items.reverse()
+	result_queue = mp_ctx.Queue()
+	num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+	file_queues = [mp_ctx.Queue() for _ in range(num_workers)]
+	workers = [mp_ctx.Process(target = batch_worker, args = (i, num_threads, file_queues[i], result_queue), daemon = True) for i in range(num_workers)]
+	for p in workers :
+		p.start()
+	# worker id -> (filename, dst_filename, src_hash) it is working on
+	current = {}
+	num_done = 0
+
+	def finish(worker_id: int, item: tuple, state: str) :
+		nonlocal num_done
+		num_done += 1
+		filename, dst_filename, src_hash = item
+		print(f' -- [{num_done}/{num_files}] worker {worker_id} {filename}: {state}')
+		manifest.mark(os.path.relpath(filename, src), src_hash, state, dst_filename)
+
+	def hand_out(worker_id: int) :
+		if items :
+			current[worker_id] = items.pop()
+			file_queues[worker_id].put(current[worker_id])
+		else :
+			file_queues[worker_id].put(None)
+
+	for worker_id in range(num_workers) :
+		hand_out(worker_id)
+	while current :
+		try :
+			worker_id, filename, state = result_queue.get(timeout = 1)
+		except queue.Empty :
+			for worker_id in list(current) :
+				if workers[worker_id].exitcode is not None :
+					print(f' -- Worker {worker_id} died with exit code {workers[worker_id].exitcode}')
+					finish(worker_id, current.pop(worker_id), 'failed')
+			if not current :
+				# every worker died, nobody is left for the remaining pages
+				while items :
+					finish(-1, items.pop(), 'failed')
+			continue
+		finish(worker_id, current.pop(worker_id), state)
+		hand_out(worker_id)
+	for p in workers :
+		p.join(timeout = 10)
+
+def prepare(mode: str) :
+	global STAGE_CACHE
 	os.makedirs('result', exist_ok = True)
 	text_render.prepare_renderer()
-	with open('alphabet-all-v5.txt', 'r', encoding = 'utf-8') as fp :
-		dictionary = [s[:-1] for s in fp.readlines()]
-	load_ocr_model(dictionary, args.use_cuda, args.ocr_model)
-	from textblockdetector import load_model as load_ctd_model
-	load_ctd_model(args.use_cuda)
-	load_detection_model(args.use_cuda)
-	load_inpainting_model(args.use_cuda, args.inpainting_model)
+	register_models()
+	if args.stage_cache_size > 0 and mode != 'bench' :
+		STAGE_CACHE = StageCache(args.stage_cache_dir, args.stage_cache_size * 1024 * 1024)
+	if args.translation_cache and mode != 'bench' :
+		# bench mode never translates and stays offline, importing the translators is not
+		from translators import enable_cache as enable_translation_cache
+		enable_translation_cache(args.translation_cache)
+	if args.translator_rate_limits and mode != 'bench' :
+		from translators import enable_rate_limits, parse_rate_limits
+		enable_rate_limits(parse_rate_limits(args.translator_rate_limits))
+
+def run_batch() :
+	# not async, worker processes are forked and that must not happen while an event loop is running
+	src = os.path.abspath(args.image)
+	if src[-1] == '\\' or src[-1] == '/' :
+		src = src[:-1]
+	dst = args.image_dst or src + '-translated'
+	if os.path.exists(dst) and not os.path.isdir(dst) :
+		print(f'Destination `{dst}` already exists and is not a directory! Please specify another directory.')
+		return
+	if os.path.exists(dst) and os.listdir(dst) and not os.path.exists(os.path.join(dst, MANIFEST_NAME)) :
+		print(f'Destination directory `{dst}` already exists! Please specify another directory.')
+		return
+	os.makedirs(dst, exist_ok = True)
+	manifest = BatchManifest(dst)
+	if manifest.entries :
+		print(f' -- Resuming batch from {manifest.path}')
+	print('Processing image in source directory')
+	num_workers = args.workers
+	if num_workers > 1 and args.use_cuda :
+		print(' -- Worker processes cannot share CUDA models, falling back to a single worker')
+		num_workers = 1
+	if num_workers > 1 and not hasattr(os, 'fork') :
+		print(' -- Worker processes require fork, falling back to a single worker')
+		num_workers = 1
+	if num_workers > 1 :
+		print(' -- Loading models')
+		preload_models(required_models())
+		print(f' -- Running {num_workers} batch workers')
+		run_batch_workers(src, dst, num_workers, manifest)
+	else :
+		run_batch_pipeline(src, dst, manifest)
+	manifest.close()
+
+async def main(mode = 'demo') :
+	global WEB_LOOP
+	prepare(mode)
 
 	if mode == 'demo' :
 		print(' -- Running in single image demo mode')
@@ -276,93 +756,38 @@ async def main(mode = 'demo') :
 			return
 		img, alpha_ch = convert_img(Image.open(args.image))
 		img = np.array(img)
-		await infer(img, mode, '', alpha_ch = alpha_ch)
+		await infer(img, mode, alpha_ch = alpha_ch)
+		await close_translator_sessions()
 	elif mode == 'web' :
 		print(' -- Running in web service mode')
+		import web_main
+		WEB_LOOP = asyncio.get_running_loop()
+		num_workers = max(1, args.workers)
+		if num_workers > 1 :
+			# torch and OpenCV pools are process wide, split the cores between the workers
+			import torch
+			num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+			torch.set_num_threads(num_threads)
+			cv2.setNumThreads(num_threads)
+			print(f' -- Running {num_workers} inference workers with {num_threads} threads each')
+		runner, _ = await web_main.start_async_app(args.host, args.port, num_workers, args.result_cache_size * 1024 * 1024, args.task_db, args.max_queue_size, split_names(args.translator_failover, args.translator))
 		print(' -- Waiting for translation tasks')
-		nonce = crypto_utils.rand_bytes(16).hex()
-		import subprocess
-		import sys
-
-		extra_web_args = {'stdout':sys.stdout, 'stderr':sys.stderr} if args.log_web else {}
-		web_executable = [sys.executable, '-u'] if args.log_web else [sys.executable]
-		web_process_args = ['web_main.py', nonce, str(args.host), str(args.port)]
-		subprocess.Popen([*web_executable, *web_process_args], **extra_web_args)
-		
-		while True :
-			try :
-				task_id, options = get_task(nonce)
-				if task_id :
-					try :
-						print(f' -- Processing task {task_id}')
-						img, alpha_ch = convert_img(Image.open(f'result/{task_id}/input.png'))
-						img = np.array(img)
-						infer_task = asyncio.create_task(infer_safe(img, mode, nonce, options, task_id, alpha_ch = alpha_ch))
-						asyncio.gather(infer_task)
-					except Exception :
-						import traceback
-						traceback.print_exc()
-						update_state(task_id, nonce, 'error')
-				else :
-					await asyncio.sleep(0.1)
-			except Exception :
-				import traceback
-				traceback.print_exc()
-	elif mode == 'web2' :
-		print(' -- Running in web service mode')
-		print(' -- Waiting for translation tasks')
-		while True :
-			task_id, options = get_task(nonce)
-			if task_id :
-				print(f' -- Processing task {task_id}')
-				try :
-					img, alpha_ch = convert_img(Image.open(f'result/{task_id}/input.png'))
-					img = np.array(img)
-					infer_task = asyncio.create_task(infer_safe(img, mode, nonce, options, task_id, alpha_ch = alpha_ch))
-					asyncio.gather(infer_task)
-				except Exception :
-					import traceback
-					traceback.print_exc()
-					update_state(task_id, nonce, 'error')
-			else :
-				await asyncio.sleep(0.1)
-	elif mode == 'batch' :
-		src = os.path.abspath(args.image)
-		if src[-1] == '\\' or src[-1] == '/' :
-			src = src[:-1]
-		dst = args.image_dst or src + '-translated'
-		if os.path.exists(dst) and not os.path.isdir(dst) :
-			print(f'Destination `{dst}` already exists and is not a directory! Please specify another directory.')
-			return
-		if os.path.exists(dst) and os.listdir(dst) :
-			print(f'Destination directory `{dst}` already exists! Please specify another directory.')
-			return
-		print('Processing image in source directory')
-		files = []
-		for root, subdirs, files in os.walk(src) :
-			dst_root = replace_prefix(root, src, dst)
-			os.makedirs(dst_root, exist_ok = True)
-			for f in files :
-				if f.lower() == '.thumb' :
-					continue
-				filename = os.path.join(root, f)
-				try :
-					img, alpha_ch = convert_img(Image.open(filename))
-					img = np.array(img)
-					if img is None :
-						continue
-				except Exception :
-					pass
-				try :
-					dst_filename = replace_prefix(filename, src, dst)
-					print('Processing', filename, '->', dst_filename)
-					await infer(img, 'demo', '', dst_image_name = dst_filename, alpha_ch = alpha_ch)
-				except Exception :
-					import traceback
-					traceback.print_exc()
-					pass
+		for worker_id in range(num_workers) :
+			threading.Thread(target = run_web_worker, args = (worker_id,), name = f'web-worker-{worker_id}', daemon = True).start()
+		try :
+			# serve until interrupted
+			await asyncio.Event().wait()
+		finally :
+			await runner.cleanup()
+	elif mode == 'bench' :
+		print(' -- Running in benchmark mode')
+		await run_benchmark()
 
 if __name__ == '__main__':
 	print(args)
-	loop = asyncio.get_event_loop()
-	loop.run_until_complete(main(args.mode))
+	if args.mode == 'batch' :
+		prepare(args.mode)
+		run_batch()
+	else :
+		loop = asyncio.get_event_loop()
+		loop.run_until_complete(main(args.mode))
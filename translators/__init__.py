@@ -1,6 +1,12 @@
 
-from typing import List
+import time
+import asyncio
+from typing import Callable, List, Optional
 from . import baidu, google, youdao, deepl, papago
+from .cache import TranslationCache, normalize_text
+from .session import close_sessions
+from .resilience import CircuitBreaker, backoff_delay
+from .rate_limit import RateLimiter, parse_rate_limits
 
 import googletrans
 
@@ -144,7 +150,54 @@ except Exception as e:
 	print(f'fail to initialize deepl :\n{str(e)} \nswitch to google translator')
 
 
-async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, **kwargs) -> List[str] :
+# (max characters, max lines) of one request, longer inputs are split and sent as several requests
+CHUNK_LIMITS = {
+	'google': (5000, 100),
+	'baidu': (2000, 100),
+	'youdao': (5000, 100),
+	'deepl': (5000, 100),
+	'papago': (3000, 100),
+}
+# requests of one `dispatch` call in flight at the same time
+MAX_CONCURRENT_CHUNKS = 4
+
+# (requests per second, characters per second) of every provider, conservative guesses of the free tiers
+DEFAULT_RATE_LIMITS = {
+	'google': (5, 10000),
+	'baidu': (1, 2000),
+	'youdao': (2, 5000),
+	'deepl': (3, 10000),
+	'papago': (2, 5000),
+}
+# provider name -> RateLimiter, see `enable_rate_limits`
+RATE_LIMITERS = {name: RateLimiter(*limits) for name, limits in DEFAULT_RATE_LIMITS.items()}
+# called with (provider, seconds waited) before every request that had to wait
+RATE_LIMIT_OBSERVER = None
+
+# provider name -> CircuitBreaker, see `dispatch_with_failover`
+BREAKERS = {}
+
+# translation memory shared by all providers, see `enable_cache`
+TRANSLATION_CACHE = None
+
+def enable_cache(path: str, memory_size: int = 10000) :
+	global TRANSLATION_CACHE
+	TRANSLATION_CACHE = TranslationCache(path, memory_size)
+
+def flush_cache() :
+	if TRANSLATION_CACHE is not None :
+		TRANSLATION_CACHE.flush()
+
+def enable_rate_limits(limits: dict) :
+	"""Replace the limits of the providers in `limits`, provider -> (requests per second, characters per second)."""
+	for name, (requests_per_second, chars_per_second) in limits.items() :
+		RATE_LIMITERS[name] = RateLimiter(requests_per_second, chars_per_second)
+
+def set_rate_limit_observer(observer: Optional[Callable]) :
+	global RATE_LIMIT_OBSERVER
+	RATE_LIMIT_OBSERVER = observer
+
+async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, timeout: Optional[float] = None, **kwargs) -> List[str] :
 	if translator not in ['google', 'youdao', 'baidu', 'deepl', 'eztrans', 'papago', 'null'] :
 		raise Exception
 	if translator == 'null' :
@@ -155,6 +208,98 @@ async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[st
 		raise Exception
 	if src_lang not in VALID_LANGUAGES and src_lang != 'auto' :
 		raise Exception
+	if TRANSLATION_CACHE is None :
+		return await dispatch_uncached(translator, src_lang, tgt_lang, texts, *args, timeout = timeout, **kwargs)
+	keys = [normalize_text(txt) for txt in texts]
+	cached = await TRANSLATION_CACHE.get_many(translator, src_lang, tgt_lang, set(k for k in keys if k))
+	# only the first occurrence of every line missing from the cache is sent
+	misses = {}
+	for key, txt in zip(keys, texts) :
+		if key and key not in cached and key not in misses :
+			misses[key] = txt
+	if misses :
+		result = await dispatch_uncached(translator, src_lang, tgt_lang, list(misses.values()), *args, timeout = timeout, **kwargs)
+		# empty results are mostly padding of a length mismatch, not worth remembering
+		TRANSLATION_CACHE.put_many(translator, src_lang, tgt_lang, [(key, trans) for key, trans in zip(misses.keys(), result) if trans])
+		cached.update(zip(misses.keys(), result))
+	return [cached[key] if key else '' for key in keys]
+
+def split_chunks(translator: str, texts: List[str]) -> List[List[str]] :
+	"""Split `texts` into consecutive chunks within the request limits of `translator`.
+
+	A single line longer than the character limit gets a chunk of its own.
+	"""
+	max_chars, max_lines = CHUNK_LIMITS.get(translator, (5000, 100))
+	chunks = []
+	chunk = []
+	num_chars = 0
+	for txt in texts :
+		# every line but the first adds a '\n' separator
+		size = len(txt) + (1 if chunk else 0)
+		if chunk and (num_chars + size > max_chars or len(chunk) >= max_lines) :
+			chunks.append(chunk)
+			chunk = []
+			size = len(txt)
+			num_chars = 0
+		chunk.append(txt)
+		num_chars += size
+	if chunk :
+		chunks.append(chunk)
+	return chunks
+
+def get_breaker(translator: str) -> CircuitBreaker :
+	if translator not in BREAKERS :
+		BREAKERS[translator] = CircuitBreaker()
+	return BREAKERS[translator]
+
+def supports(translator: str, src_lang: str, tgt_lang: str) -> bool :
+	if translator in ['null', 'eztrans'] :
+		return True
+	if translator not in LANGUAGE_CODE_MAP :
+		return False
+	codes = LANGUAGE_CODE_MAP[translator]
+	return codes.get(tgt_lang, 'NONE') != 'NONE' and (src_lang == 'auto' or codes.get(src_lang, 'NONE') != 'NONE')
+
+async def dispatch_with_failover(translators: List[str], src_lang: str, tgt_lang: str, texts: List[str], attempts: int = 3, timeout: float = 15, observer: Optional[Callable] = None) -> List[str] :
+	"""`dispatch` to the first of `translators` that succeeds.
+
+	Each translator gets up to `attempts` tries with jittered exponential backoff
+	in between, every request of a try has to finish within `timeout` seconds
+	not counting the time spent waiting on the rate limit. Translators whose
+	circuit breaker is open, or which do not support the language pair, are
+	skipped right away.
+	`observer(translator, seconds, error)` is called after every try, `error` is None on success.
+	"""
+	last_error = None
+	for translator in translators :
+		if not supports(translator, src_lang, tgt_lang) :
+			continue
+		breaker = get_breaker(translator)
+		for attempt in range(attempts) :
+			if not breaker.allow() :
+				break
+			start = time.perf_counter()
+			try :
+				result = await dispatch(translator, src_lang, tgt_lang, texts, timeout = timeout)
+			except asyncio.CancelledError :
+				breaker.release()
+				raise
+			except Exception as ex :
+				breaker.record_failure()
+				last_error = ex
+				if observer is not None :
+					observer(translator, time.perf_counter() - start, ex)
+				if attempt + 1 < attempts and breaker.state == 'closed' :
+					await asyncio.sleep(backoff_delay(attempt))
+				continue
+			breaker.record_success()
+			if observer is not None :
+				observer(translator, time.perf_counter() - start, None)
+			return result
+		print(f' -- Translator {translator} unavailable, circuit {breaker.state}')
+	raise Exception(f'No translator of {translators} could translate to {tgt_lang}') from last_error
+
+async def dispatch_uncached(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, timeout: Optional[float] = None, **kwargs) -> List[str] :
 	if translator == 'eztrans':
 		tgt_lang = 'KOR'
 		src_lang = 'JPN'
@@ -165,6 +310,36 @@ async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[st
 	if tgt_lang == 'NONE' or src_lang == 'NONE' :
 		raise Exception
 
+	chunks = split_chunks(translator, texts)
+	if len(chunks) == 1 :
+		return await translate_chunk(translator, src_lang, tgt_lang, texts, *args, timeout = timeout, **kwargs)
+	semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNKS)
+	async def run_chunk(chunk: List[str]) -> List[str] :
+		async with semaphore :
+			return await translate_chunk(translator, src_lang, tgt_lang, chunk, *args, timeout = timeout, **kwargs)
+	# gather keeps the order of the chunks, and every chunk is already padded to its own length
+	results = await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+	return [trans for result in results for trans in result]
+
+async def translate_chunk(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, timeout: Optional[float] = None, **kwargs) -> List[str] :
+	"""One request to `translator` with provider language codes, padded or cut to `len(texts)` lines."""
+	limiter = RATE_LIMITERS.get(translator)
+	if limiter is not None :
+		waited = await limiter.acquire(len('\n'.join(texts)))
+		if waited > 0 and RATE_LIMIT_OBSERVER is not None :
+			RATE_LIMIT_OBSERVER(translator, waited)
+	result = await asyncio.wait_for(request_chunk(translator, src_lang, tgt_lang, texts, *args, **kwargs), timeout = timeout)
+	translated_sentences = []
+	if len(result) < len(texts) :
+		translated_sentences.extend(result)
+		translated_sentences.extend([''] * (len(texts) - len(result)))
+	elif len(result) > len(texts) :
+		translated_sentences.extend(result[: len(texts)])
+	else :
+		translated_sentences.extend(result)
+	return translated_sentences
+
+async def request_chunk(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, **kwargs) -> List[str] :
 	if translator == 'google' :
 		concat_texts = '\n'.join(texts)
 		empty_l = 0
@@ -193,15 +368,7 @@ async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[st
 	elif translator == 'papago' :
 		concat_texts = '\n'.join(texts)
 		result = await PAPAGO_CLIENT.translate(src_lang, tgt_lang, concat_texts)
-	translated_sentences = []
-	if len(result) < len(texts) :
-		translated_sentences.extend(result)
-		translated_sentences.extend([''] * (len(texts) - len(result)))
-	elif len(result) > len(texts) :
-		translated_sentences.extend(result[: len(texts)])
-	else :
-		translated_sentences.extend(result)
-	return translated_sentences
+	return result
 
 async def test() :
 	src = '测试'
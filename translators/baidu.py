@@ -15,7 +15,7 @@ from .keys import APP_ID, SECRET_KEY
 BASE_URL = 'api.fanyi.baidu.com'
 API_URL = '/api/trans/vip/translate'
 
-import aiohttp
+from .session import get_session
 
 class Translator(object):
 	def __init__(self):
@@ -23,9 +23,8 @@ class Translator(object):
 
 	async def translate(self, from_lang, to_lang, query_text):
 		url = self.get_url(from_lang, to_lang, query_text)
-		async with aiohttp.ClientSession() as session:
-			async with session.get('https://'+BASE_URL+url) as resp:
-				result = await resp.json()
+		async with get_session('baidu').get('https://'+BASE_URL+url) as resp:
+			result = await resp.json()
 		result_list = []
 		for ret in result["trans_result"]:
 			for v in ret["dst"].split('\n') :
@@ -0,0 +1,105 @@
+import os
+import re
+import sqlite3
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+# bound parameters of one SELECT, older SQLite builds allow at most 999
+MAX_QUERY_TEXTS = 500
+
+def normalize_text(text: str) -> str :
+	"""Cache key of a source line, OCR output of the same line differs in width forms and spacing."""
+	return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+
+class TranslationCache(object) :
+	"""Translation memory keyed by (provider, source language, target language, normalized text).
+
+	Entries live in SQLite with the most recently used ones also kept in memory.
+	SQLite is only used from a single thread of the cache so a slow disk or a
+	write lock held by another process never blocks the caller's event loop.
+	The connection and thread are recreated after a fork so batch workers can
+	share the file.
+	"""
+	def __init__(self, path: str, memory_size: int = 10000) :
+		self.path = path
+		self.memory_size = memory_size
+		self.hits = 0
+		self.misses = 0
+		self._memory = OrderedDict()
+		self._lock = threading.Lock()
+		self._db = None
+		self._executor = None
+		self._pid = None
+		os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+	def _get_executor(self) -> ThreadPoolExecutor :
+		if self._pid != os.getpid() :
+			self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'translation-cache')
+			self._db = None
+			self._pid = os.getpid()
+		return self._executor
+
+	def _connect(self) :
+		if self._db is None :
+			self._db = sqlite3.connect(self.path, check_same_thread = False, isolation_level = None, timeout = 30)
+			self._db.execute('PRAGMA journal_mode=WAL')
+			self._db.execute('CREATE TABLE IF NOT EXISTS translations (provider TEXT NOT NULL, src TEXT NOT NULL, tgt TEXT NOT NULL, text TEXT NOT NULL, translation TEXT NOT NULL, PRIMARY KEY (provider, src, tgt, text))')
+		return self._db
+
+	def _remember(self, key: Tuple, translation: str) :
+		self._memory[key] = translation
+		self._memory.move_to_end(key)
+		while len(self._memory) > self.memory_size :
+			self._memory.popitem(last = False)
+
+	async def get_many(self, provider: str, src: str, tgt: str, texts: Iterable[str]) -> Dict[str, str] :
+		"""Cached translations of the normalized `texts` that have one."""
+		texts = list(texts)
+		found = {}
+		missing = []
+		with self._lock :
+			for text in texts :
+				key = (provider, src, tgt, text)
+				if key in self._memory :
+					self._memory.move_to_end(key)
+					found[text] = self._memory[key]
+				else :
+					missing.append(text)
+		if missing :
+			rows = await asyncio.get_running_loop().run_in_executor(self._get_executor(), self._select, provider, src, tgt, missing)
+			with self._lock :
+				for text, translation in rows :
+					found[text] = translation
+					self._remember((provider, src, tgt, text), translation)
+		with self._lock :
+			self.hits += len(found)
+			self.misses += len(texts) - len(found)
+		return found
+
+	def _select(self, provider: str, src: str, tgt: str, texts: List[str]) -> List[Tuple[str, str]] :
+		db = self._connect()
+		rows = []
+		for i in range(0, len(texts), MAX_QUERY_TEXTS) :
+			chunk = texts[i: i + MAX_QUERY_TEXTS]
+			placeholders = ','.join('?' * len(chunk))
+			rows.extend(db.execute(f'SELECT text, translation FROM translations WHERE provider = ? AND src = ? AND tgt = ? AND text IN ({placeholders})', (provider, src, tgt, *chunk)).fetchall())
+		return rows
+
+	def put_many(self, provider: str, src: str, tgt: str, translations: List[Tuple[str, str]]) :
+		"""Remember `translations` in memory now, they are written to SQLite in the background."""
+		with self._lock :
+			for text, translation in translations :
+				self._remember((provider, src, tgt, text), translation)
+		self._get_executor().submit(self._insert, provider, src, tgt, translations)
+
+	def flush(self) :
+		"""Wait for the background writes of this process, forked batch workers exit without running atexit."""
+		if self._pid == os.getpid() :
+			self._executor.submit(int).result()
+
+	def _insert(self, provider: str, src: str, tgt: str, translations: List[Tuple[str, str]]) :
+		self._connect().executemany('INSERT OR REPLACE INTO translations (provider, src, tgt, text, translation) VALUES (?, ?, ?, ?, ?)', [(provider, src, tgt, text, translation) for (text, translation) in translations])
@@ -3,12 +3,13 @@
 import uuid
 import hashlib
 import hmac, base64
-import aiohttp
 import time
 import requests
 import re
 from urllib.parse import quote
 
+from .session import get_session
+
 PAPAGO_URL = 'https://papago.naver.com/apis/n2mt/translate'
 
 def get_key():
@@ -33,9 +34,8 @@ async def do_request(data, version_key):
 		"Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
 		"Timestamp": str(timestamp),
 	}
-	async with aiohttp.ClientSession() as session:
-		async with session.post(PAPAGO_URL, data=data, headers=headers) as resp:
-			return await resp.json()
+	async with get_session('papago').post(PAPAGO_URL, data=data, headers=headers) as resp:
+		return await resp.json()
 
 class Translator(object):
 	def __init__(self):
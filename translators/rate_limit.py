@@ -0,0 +1,60 @@
+import time
+import asyncio
+import threading
+from typing import Dict, Tuple
+
+class TokenBucket(object) :
+	"""`rate` tokens per second, holding at most `capacity`.
+
+	Tokens are reserved ahead, a taker finding the bucket short is told how long
+	to wait and later takers queue behind it, so over-limit requests are delayed
+	in order instead of failing.
+	"""
+	def __init__(self, rate: float, capacity: float = 0) :
+		self.rate = rate
+		self.capacity = max(capacity or rate, 1)
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def reserve(self, amount: float) -> float :
+		"""Take `amount` tokens and return the seconds until they are actually available."""
+		with self._lock :
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= amount
+			return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter(object) :
+	"""Requests per second and characters per second of one provider, 0 leaves that one unlimited."""
+	def __init__(self, requests_per_second: float, chars_per_second: float) :
+		self.requests = TokenBucket(requests_per_second) if requests_per_second > 0 else None
+		self.chars = TokenBucket(chars_per_second) if chars_per_second > 0 else None
+		self.waiting = 0
+
+	async def acquire(self, num_chars: int) -> float :
+		"""Wait until a request of `num_chars` characters may be sent, returns the seconds waited."""
+		wait = 0.0
+		if self.requests is not None :
+			wait = max(wait, self.requests.reserve(1))
+		if self.chars is not None :
+			wait = max(wait, self.chars.reserve(num_chars))
+		if wait > 0 :
+			self.waiting += 1
+			try :
+				await asyncio.sleep(wait)
+			finally :
+				self.waiting -= 1
+		return wait
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]] :
+	"""Parse `google=5:10000,baidu=1:2000` into provider -> (requests per second, characters per second)."""
+	limits = {}
+	for item in spec.split(',') :
+		if not item.strip() :
+			continue
+		name, values = item.split('=')
+		requests_per_second, chars_per_second = values.split(':')
+		limits[name.strip()] = (float(requests_per_second), float(chars_per_second))
+	return limits
@@ -0,0 +1,57 @@
+import random
+import threading
+import time
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10.0) -> float :
+	"""Seconds to wait before retry `attempt + 1`, exponential with full jitter so clients do not retry in lockstep."""
+	return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker(object) :
+	"""Stops calls to a failing provider.
+
+	Closed until `failure_threshold` calls in a row fail, then open for
+	`reset_timeout` seconds during which `allow` refuses every call. After that
+	one trial call is let through (half-open), success closes the breaker and
+	failure opens it again.
+	"""
+	def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0) :
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.state = 'closed'
+		self.failures = 0
+		self.opened_at = 0.0
+		self._trial = False
+		self._lock = threading.Lock()
+
+	def allow(self) -> bool :
+		with self._lock :
+			if self.state == 'closed' :
+				return True
+			if self.state == 'open' :
+				if time.monotonic() - self.opened_at < self.reset_timeout :
+					return False
+				self.state = 'half-open'
+				self._trial = False
+			if self._trial :
+				return False
+			self._trial = True
+			return True
+
+	def release(self) :
+		"""Give back the half-open trial of a call that was cancelled before it finished."""
+		with self._lock :
+			self._trial = False
+
+	def record_success(self) :
+		with self._lock :
+			self.state = 'closed'
+			self.failures = 0
+			self._trial = False
+
+	def record_failure(self) :
+		with self._lock :
+			self.failures += 1
+			if self.state == 'half-open' or self.failures >= self.failure_threshold :
+				self.state = 'open'
+				self.opened_at = time.monotonic()
+				self._trial = False
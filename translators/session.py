@@ -0,0 +1,31 @@
+import asyncio
+from typing import Dict, Tuple
+
+import aiohttp
+
+# connections kept to one translation API at most
+LIMIT_PER_HOST = 8
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+# (backend name, event loop) -> session, a session can only be used on the loop it was created on
+_SESSIONS: Dict[Tuple[str, asyncio.AbstractEventLoop], aiohttp.ClientSession] = {}
+
+def get_session(name: str) -> aiohttp.ClientSession :
+	"""Long-lived keep-alive session of backend `name` on the running loop, created on first use."""
+	loop = asyncio.get_running_loop()
+	session = _SESSIONS.get((name, loop))
+	if session is None or session.closed :
+		connector = aiohttp.TCPConnector(limit_per_host = LIMIT_PER_HOST, use_dns_cache = True, ttl_dns_cache = DNS_CACHE_TTL, keepalive_timeout = KEEPALIVE_TIMEOUT)
+		session = aiohttp.ClientSession(connector = connector)
+		_SESSIONS[(name, loop)] = session
+	return session
+
+async def close_sessions() :
+	"""Close the sessions of the running loop and forget those of loops that are already closed."""
+	loop = asyncio.get_running_loop()
+	for key in list(_SESSIONS) :
+		if key[1] is loop :
+			await _SESSIONS.pop(key).close()
+		elif key[1].is_closed() :
+			_SESSIONS.pop(key)
@@ -1,8 +1,13 @@
 import io
 import os
-import sys
+import re
+import json
+import zipfile
 import time
+import math
+import heapq
 import asyncio
+import functools
 import traceback
 import PIL
 import copy
@@ -10,44 +15,118 @@ from PIL import Image
 from oscrypto import util as crypto_utils
 from aiohttp import web
 from aiohttp import ClientSession
-from io import BytesIO
 
 from imagehash import phash
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from translators import VALID_LANGUAGES, dispatch as run_translation
+from translators import VALID_LANGUAGES, BREAKERS as TRANSLATOR_BREAKERS, RATE_LIMITERS as TRANSLATOR_RATE_LIMITERS, dispatch_with_failover, set_rate_limit_observer, close_sessions as close_translator_sessions
+from result_store import ResultStore
+from task_store import TaskStore
+from metrics import Registry, Counter, Gauge, Histogram
 
 VALID_DETECTORS = set(['default', 'ctd'])
 VALID_DIRECTIONS = set(['auto', 'horizontal'])
 
-MAX_NUM_TASKS = 1
+# automatic tasks run by one inference worker at the same time, manual tasks are not counted
+MAX_TASKS_PER_WORKER = 1
 NUM_ONGOING_TASKS = 0
-NONCE = ''
+# worker id -> number of automatic tasks it is running
+WORKER_TASKS = {}
+# task_id -> worker running it, kept out of TASK_DATA which is replaced when a task is submitted again
+TASK_WORKERS = {}
+# (task_id, estimated seconds) in queue order
 QUEUE = deque()
+# task_id -> (sequence number, estimated seconds of everything queued before it), the head of the queue has sequence NUM_POPPED
+QUEUE_SEQ = {}
+NUM_QUEUED = 0
+NUM_POPPED = 0
+QUEUED_SECONDS = 0.0
+POPPED_SECONDS = 0.0
+# new tasks are refused with 429 once this many are waiting, 0 for no limit
+MAX_QUEUE_SIZE = 0
+# translators tried in order after the requested one fails or its circuit is open
+TRANSLATOR_FAILOVER = []
+# detection size -> processing times of its most recent tasks
+PROCESSING_TIMES = {}
+# used until a task of any size has finished
+DEFAULT_TASK_SECONDS = 20.0
 TASK_DATA = {}
 TASK_STATES = {}
-
-app = web.Application(client_max_size = 1024 * 1024 * 50)
-routes = web.RouteTableDef()
-
-
-def constant_compare(a, b) :
+# finished tasks are forgotten this many seconds after creation
+TASK_TTL = 1800
+# (expires_at, task_id) of finished tasks, soonest first
+EXPIRY_HEAP = []
+# durable copy of the task tables, None when tasks are only kept in memory
+TASK_STORE = None
+# set whenever a worker may be able to pick up a task, created on the server loop
+QUEUE_EVENT = None
+# task_id -> asyncio.Event set once the translation result is available
+TRANSLATION_EVENTS = {}
+# task_id -> asyncio.Event set on the next state change of the task, replaced every time it fires
+STATE_EVENTS = {}
+# set whenever the queue moves, replaced every time it fires
+QUEUE_MOVED_EVENT = None
+FINISHED_STATES = ['finished', 'error', 'error-lang', 'error-no-txt']
+
+# size bounded index of `result/`, None when results are kept forever
+RESULT_STORE = None
+# set when the result store may have grown over its size limit
+EVICT_EVENT = None
+
+# job_id -> {'pages': [{'name', 'task_id'}], 'created_at'}, forgotten after TASK_TTL
+JOBS = {}
+MAX_JOB_PAGES = 200
+# uncompressed size of all pages of an archive, checked before anything is extracted
+MAX_JOB_BYTES = 1024 * 1024 * 500
+# pages decoded at the same time, a decoded page can take tens of MB
+JOB_DECODE_BATCH = 4
+JOB_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+# decoding, hashing and saving uploads, kept off the event loop
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = 'upload')
+
+METRICS = Registry()
+HTTP_REQUESTS = METRICS.add(Counter('http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status')))
+RESULT_CACHE_REQUESTS = METRICS.add(Counter('result_cache_requests_total', 'Uploads answered from result/ (hit), attached to an in-flight task (coalesced) or queued (miss)', ('outcome',)))
+TASKS_COMPLETED = METRICS.add(Counter('tasks_completed_total', 'Tasks reaching a final state', ('state',)))
+STAGE_SECONDS = METRICS.add(Histogram('task_stage_seconds', 'Duration of pipeline stages reported by the inference workers', ('stage',)))
+TASK_SECONDS = METRICS.add(Histogram('task_seconds', 'Total pipeline duration of finished tasks'))
+TRANSLATION_SECONDS = METRICS.add(Histogram('translation_seconds', 'Latency of successful machine translation requests', ('translator',)))
+TRANSLATION_ERRORS = METRICS.add(Counter('translation_errors_total', 'Failed or timed out machine translation attempts', ('translator',)))
+TRANSLATION_RATE_LIMIT_WAIT = METRICS.add(Histogram('translation_rate_limit_wait_seconds', 'Time translation requests were held back by the rate limit of their translator', ('translator',)))
+TRANSLATION_RATE_LIMIT_WAITING = METRICS.add(Gauge('translation_rate_limit_waiting', 'Translation requests waiting on the rate limit right now', lambda: {(name,): l.waiting for name, l in TRANSLATOR_RATE_LIMITERS.items()}, ('translator',)))
+TRANSLATION_CIRCUIT_OPEN = METRICS.add(Gauge('translation_circuit_open', 'Whether the circuit breaker of a translator is open', lambda: {(name,): int(b.state == 'open') for name, b in TRANSLATOR_BREAKERS.items()}, ('translator',)))
+METRICS.add(Gauge('queue_depth', 'Tasks waiting for a worker', lambda: len(QUEUE_SEQ)))
+METRICS.add(Gauge('tasks_in_flight', 'Automatic tasks being run by workers', lambda: NUM_ONGOING_TASKS))
+METRICS.add(Gauge('worker_tasks', 'Automatic tasks run by each worker', lambda: {(worker_id,): n for worker_id, n in WORKER_TASKS.items()}, ('worker',)))
+METRICS.add(Gauge('tasks', 'Known tasks by state', lambda: count_task_states(), ('state',)))
+METRICS.add(Gauge('result_store_bytes', 'Size of result/ tracked by the result store', lambda: RESULT_STORE.total_size if RESULT_STORE is not None else 0))
+
+def count_task_states() :
+	counts = {}
+	for state in TASK_STATES.values() :
+		counts[(state,)] = counts.get((state,), 0) + 1
+	return counts
+
+@web.middleware
+async def metrics_middleware(request, handler) :
+	status = 500
 	try :
-		if isinstance(a, str):
-			a = a.encode('utf-8')
-
-		if isinstance(b, str):
-			b = b.encode('utf-8')
-
-		if len(a) != len(b):
-			return False
-
-		result = 0
-		for x, y in zip(a, b):
-			result |= x ^ y
-		return result == 0
-	except Exception :
-		return False
+		resp = await handler(request)
+		status = resp.status
+		return resp
+	except web.HTTPException as ex :
+		status = ex.status
+		raise
+	finally :
+		resource = request.match_info.route.resource
+		HTTP_REQUESTS.inc(resource.canonical if resource is not None else 'unmatched', request.method, status)
+
+# whole request body, for /job the compressed archive or all page files together
+MAX_UPLOAD_SIZE = 1024 * 1024 * 50
+app = web.Application(client_max_size = MAX_UPLOAD_SIZE, middlewares = [metrics_middleware])
+routes = web.RouteTableDef()
 
 
 @routes.get("/")
@@ -62,17 +141,45 @@ async def index_async(request) :
 
 @routes.get("/result/{taskid}")
 async def result_async(request) :
-        im = Image.open("result/" + request.match_info.get('taskid') + "/final.png")
-        stream = BytesIO()
-        im.save(stream, "PNG")
-        return web.Response(body=stream.getvalue(), content_type='image/png')
+	task_id = request.match_info.get('taskid')
+	path = f'result/{task_id}/final.png'
+	if task_id in ['.', '..'] or not os.path.isfile(path) :
+		raise web.HTTPNotFound()
+	touch_result(task_id)
+	# a task id is derived from the image content and options so its result never changes
+	headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+	# sent straight from disk, FileResponse adds an ETag from the file's mtime and size and
+	# answers If-None-Match / If-Modified-Since with 304 and Range with 206 by itself
+	return web.FileResponse(path, headers = headers)
+
+@routes.get("/metrics")
+async def metrics_async(request) :
+	return web.Response(body = METRICS.render().encode('utf-8'), headers = {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
 @routes.get("/queue-size")
 async def queue_size_async(request) :
-	return web.json_response({'size' : len(QUEUE)})
+	return web.json_response({'size' : len(QUEUE_SEQ), 'estimated_wait': round(queue_wait_seconds(QUEUED_SECONDS), 1)})
 
-async def handle_post(request) :
-	data = await request.post()
+def decode_upload(content, with_hash) :
+	img = Image.open(io.BytesIO(content))
+	if max(img.width, img.height) > 3500 :
+		return None, None
+	img.load()
+	return img, str(phash(img, hash_size = 16)) if with_hash else None
+
+def save_input(task_id, img, content) :
+	os.makedirs(f'result/{task_id}/', exist_ok=True)
+	if img.format == 'PNG' :
+		# already PNG, no need to encode it again
+		with open(f'result/{task_id}/input.png', 'wb') as fp :
+			fp.write(content)
+	else :
+		img.save(f'result/{task_id}/input.png')
+
+async def run_in_upload_executor(func, *args) :
+	return await asyncio.get_running_loop().run_in_executor(UPLOAD_EXECUTOR, func, *args)
+
+def parse_options(data) :
 	size = ''
 	selected_translator = 'youdao'
 	target_language = 'CHS'
@@ -98,6 +205,11 @@ async def handle_post(request) :
 		size = data['size'].upper()
 		if size not in ['S', 'M', 'L', 'X'] :
 			size = ''
+	return size, selected_translator, target_language, detector, direction
+
+async def handle_post(request, with_hash = True) :
+	data = await request.post()
+	size, selected_translator, target_language, detector, direction = parse_options(data)
 	if 'file' in data :
 		file_field = data['file']
 		content = file_field.file.read()
@@ -112,23 +224,25 @@ async def handle_post(request) :
 	else :
 		return web.json_response({'status' : 'failed'})
 	try :
-		img = Image.open(io.BytesIO(content))
-		if max(img.width, img.height) > 3500 :
+		img, img_hash = await run_in_upload_executor(decode_upload, content, with_hash)
+		if img is None :
 			return web.json_response({'status' : 'failed'})
 	except :
 		return web.json_response({'status' : 'failed'})
-	return img, size, selected_translator, target_language, detector, direction
+	return img, content, img_hash, size, selected_translator, target_language, detector, direction
 
 @routes.post("/run")
 async def run_async(request) :
 	x = await handle_post(request)
 	if isinstance(x, tuple) :
-		img, size, selected_translator, target_language, detector, direction = x
+		img, content, img_hash, size, selected_translator, target_language, detector, direction = x
 	else :
 		return x
-	task_id = f'{phash(img, hash_size = 16)}-{size}-{selected_translator}-{target_language}-{detector}-{direction}'
+	task_id = f'{img_hash}-{size}-{selected_translator}-{target_language}-{detector}-{direction}'
 	print(f'New `run` task {task_id}')
-	if os.path.exists(f'result/{task_id}/final.png') :
+	if not is_in_flight(task_id) and os.path.exists(f'result/{task_id}/final.png') :
+		touch_result(task_id)
+		RESULT_CACHE_REQUESTS.inc('hit')
 		return web.json_response({'task_id' : task_id, 'status': 'successful'})
 	# elif os.path.exists(f'result/{task_id}') :
 	# 	# either image is being processed or error occurred 
@@ -136,37 +250,243 @@ async def run_async(request) :
 	# 		# error occurred
 	# 		return web.json_response({'state': 'error'})
 	else :
-		os.makedirs(f'result/{task_id}/', exist_ok=True)
-		img.save(f'result/{task_id}/input.png')
-		QUEUE.append(task_id)
-		TASK_DATA[task_id] = {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()}
-		TASK_STATES[task_id] = 'pending'
-	while True :
-		await asyncio.sleep(0.1)
-		if task_id not in TASK_STATES :
-			break
-		state = TASK_STATES[task_id]
-		if state in ['finished', 'error', 'error-lang'] :
-			break
+		await start_task(task_id, img, content, {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()})
+	state = await wait_task_state(task_id, FINISHED_STATES)
 	return web.json_response({'task_id' : task_id, 'status': 'successful' if state == 'finished' else state})
 
 
-@routes.get("/task-internal")
-async def get_task_async(request) :
-	global NONCE, NUM_ONGOING_TASKS
-	if constant_compare(request.rel_url.query['nonce'], NONCE) :
-		if len(QUEUE) > 0 and NUM_ONGOING_TASKS < MAX_NUM_TASKS :
-			task_id = QUEUE.popleft()
-			if task_id in TASK_DATA :
-				data = TASK_DATA[task_id]
-				if 'manual' not in TASK_DATA[task_id] :
-					NUM_ONGOING_TASKS += 1
-				return web.json_response({'task_id': task_id, 'data': data})
-			else :
-				return web.json_response({})
+def is_in_flight(task_id) :
+	return task_id in TASK_STATES and task_id in TASK_DATA and TASK_STATES[task_id] not in FINISHED_STATES
+
+async def start_task(task_id, img, content, data, admit = True) :
+	"""Queue a new task, if the same task is already queued or running the request shares it instead."""
+	if is_in_flight(task_id) :
+		print(f'Task {task_id} is already in flight, attaching to it')
+		RESULT_CACHE_REQUESTS.inc('coalesced')
+		return
+	if admit :
+		check_admission()
+	RESULT_CACHE_REQUESTS.inc('miss')
+	# claimed before saving the input so concurrent identical uploads see it
+	TASK_DATA[task_id] = data
+	TASK_STATES[task_id] = 'pending'
+	reset_translation(task_id)
+	persist_task(task_id)
+	try :
+		await run_in_upload_executor(save_input, task_id, img, content)
+	except Exception :
+		traceback.print_exc()
+		update_task_state(task_id, 'error')
+		return
+	enqueue_task(task_id)
+
+def reset_translation(task_id) :
+	"""Forget the translation of a previous run of the task, its event is already set."""
+	TRANSLATION_EVENTS.pop(task_id, None)
+	TASK_DATA[task_id].pop('trans_result', None)
+	TASK_DATA[task_id].pop('trans_request', None)
+
+def enqueue_task(task_id) :
+	global NUM_QUEUED, QUEUED_SECONDS
+	reset_translation(task_id)
+	cost = estimate_task_seconds(TASK_DATA[task_id].get('size', ''))
+	QUEUE.append((task_id, cost))
+	QUEUE_SEQ[task_id] = (NUM_QUEUED, QUEUED_SECONDS)
+	NUM_QUEUED += 1
+	QUEUED_SECONDS += cost
+	QUEUE_EVENT.set()
+
+def estimate_task_seconds(size) :
+	"""Mean of the rolling processing times of tasks of this size, falling back to all sizes."""
+	times = PROCESSING_TIMES.get(size)
+	if not times :
+		times = [t for ts in PROCESSING_TIMES.values() for t in ts]
+	if not times :
+		return DEFAULT_TASK_SECONDS
+	return sum(times) / len(times)
+
+def record_processing_time(task_id) :
+	data = TASK_DATA[task_id]
+	if 'started_at' in data :
+		PROCESSING_TIMES.setdefault(data.get('size', ''), deque(maxlen = 32)).append(time.time() - data['started_at'])
+
+def queue_wait_seconds(queued_before) :
+	"""Estimated seconds until the work queued before `queued_before` is picked up by the workers."""
+	return max(0.0, queued_before - POPPED_SECONDS) / max(1, len(WORKER_TASKS))
+
+def check_admission(num_tasks = 1) :
+	if MAX_QUEUE_SIZE > 0 and len(QUEUE_SEQ) + num_tasks > MAX_QUEUE_SIZE :
+		# roughly when the head of the queue moves
+		retry_after = math.ceil(estimate_task_seconds('') / max(1, len(WORKER_TASKS)))
+		raise web.HTTPTooManyRequests(headers = {'Retry-After': str(max(1, retry_after))})
+
+def persist_task(task_id) :
+	if TASK_STORE is not None :
+		TASK_STORE.put(task_id, TASK_STATES[task_id], TASK_DATA[task_id])
+
+def schedule_expiry(task_id) :
+	heapq.heappush(EXPIRY_HEAP, (TASK_DATA[task_id]['created_at'] + TASK_TTL, task_id))
+
+async def expire_tasks_forever() :
+	"""Forget finished tasks once they are TASK_TTL seconds old, sleeping until the next one is due."""
+	while True :
+		now = time.time()
+		while EXPIRY_HEAP and EXPIRY_HEAP[0][0] <= now :
+			_, tid = heapq.heappop(EXPIRY_HEAP)
+			# entries of tasks that were started again since are stale
+			if tid in TASK_STATES and tid in TASK_DATA and TASK_STATES[tid] in FINISHED_STATES and TASK_DATA[tid]['created_at'] + TASK_TTL <= now :
+				remove_task(tid)
+		delay = EXPIRY_HEAP[0][0] - now if EXPIRY_HEAP else TASK_TTL
+		await asyncio.sleep(min(max(delay, 0.1), 60))
+
+def notify_task(task_id) :
+	event = STATE_EVENTS.pop(task_id, None)
+	if event is not None :
+		event.set()
+
+def notify_queue_moved() :
+	global QUEUE_MOVED_EVENT
+	QUEUE_MOVED_EVENT.set()
+	QUEUE_MOVED_EVENT = asyncio.Event()
+
+async def wait_task_changed(task_id) :
+	"""Return on the next state change of `task_id`, including its removal."""
+	await STATE_EVENTS.setdefault(task_id, asyncio.Event()).wait()
+
+async def wait_task_state(task_id, states) :
+	"""Return the state of `task_id` once it is one of `states`, or None if the task is removed first."""
+	while task_id in TASK_STATES :
+		if TASK_STATES[task_id] in states :
+			return TASK_STATES[task_id]
+		await wait_task_changed(task_id)
+	return None
+
+def pop_task(worker_id) :
+	global NUM_ONGOING_TASKS, NUM_POPPED, POPPED_SECONDS
+	while len(QUEUE) > 0 and WORKER_TASKS.get(worker_id, 0) < MAX_TASKS_PER_WORKER :
+		task_id, cost = QUEUE.popleft()
+		if QUEUE_SEQ.get(task_id, (None,))[0] == NUM_POPPED :
+			del QUEUE_SEQ[task_id]
+		NUM_POPPED += 1
+		POPPED_SECONDS += cost
+		if task_id in TASK_DATA :
+			data = TASK_DATA[task_id]
+			if 'manual' not in TASK_DATA[task_id] :
+				NUM_ONGOING_TASKS += 1
+				WORKER_TASKS[worker_id] = WORKER_TASKS.get(worker_id, 0) + 1
+				TASK_WORKERS[task_id] = worker_id
+				data['started_at'] = time.time()
+			notify_queue_moved()
+			return task_id, data
+	return None, None
+
+async def wait_for_task(worker_id = 0) :
+	"""Called by inference workers, returns the next task as soon as worker `worker_id` can start one."""
+	while True :
+		task_id, data = pop_task(worker_id)
+		if task_id :
+			return task_id, data
+		QUEUE_EVENT.clear()
+		await QUEUE_EVENT.wait()
+
+def update_task_state(task_id, state, trace = None) :
+	global NUM_ONGOING_TASKS
+	# the slot is given back even if the task was removed or replaced meanwhile
+	if state in FINISHED_STATES and task_id in TASK_WORKERS :
+		NUM_ONGOING_TASKS -= 1
+		WORKER_TASKS[TASK_WORKERS.pop(task_id)] -= 1
+		QUEUE_EVENT.set()
+	if task_id in TASK_STATES and task_id in TASK_DATA :
+		TASK_STATES[task_id] = state
+		if TASK_STORE is not None :
+			TASK_STORE.set_state(task_id, state)
+		if trace is not None :
+			TASK_DATA[task_id]['trace'] = trace
+			for s in trace['stages'] :
+				STAGE_SECONDS.observe(s['wall'], s['stage'])
+			TASK_SECONDS.observe(trace['total_wall'])
+		if state == 'finished' :
+			record_processing_time(task_id)
+		print(f'Task state {task_id} to {TASK_STATES[task_id]}')
+		notify_task(task_id)
+		if state in FINISHED_STATES :
+			TASKS_COMPLETED.inc(state)
+			schedule_expiry(task_id)
+			if RESULT_STORE is not None :
+				asyncio.ensure_future(store_result(task_id))
+
+def touch_result(task_id) :
+	if RESULT_STORE is not None :
+		RESULT_STORE.touch(task_id)
+
+async def store_result(task_id) :
+	await run_in_upload_executor(RESULT_STORE.add, task_id)
+	if RESULT_STORE.total_size > RESULT_STORE.max_size :
+		EVICT_EVENT.set()
+
+async def evict_results_forever(interval = 600) :
+	"""Background evictor of `result/`, runs when a result pushes it over the limit and every `interval` seconds."""
+	while True :
+		try :
+			await asyncio.wait_for(EVICT_EVENT.wait(), timeout = interval)
+		except asyncio.TimeoutError :
+			pass
+		EVICT_EVENT.clear()
+		try :
+			# queued and running tasks still need their input
+			active = set(QUEUE_SEQ) | set(tid for tid, state in TASK_STATES.items() if state not in FINISHED_STATES)
+			removed = await run_in_upload_executor(RESULT_STORE.evict, active)
+			for tid in removed :
+				if tid in TASK_STATES and TASK_STATES[tid] in FINISHED_STATES :
+					remove_task(tid)
+			if removed :
+				print(f' -- Evicted {len(removed)} results, result store now {RESULT_STORE.total_size / 1024 / 1024:.1f}MB')
+		except Exception :
+			traceback.print_exc()
+
+def remove_task(task_id) :
+	if TASK_STORE is not None and task_id in TASK_STATES :
+		TASK_STORE.remove(task_id)
+	TASK_STATES.pop(task_id, None)
+	TASK_DATA.pop(task_id, None)
+	TRANSLATION_EVENTS.pop(task_id, None)
+	notify_task(task_id)
+
+def set_translation_result(task_id, result) :
+	if task_id not in TASK_DATA :
+		TASK_DATA[task_id] = {}
+	TASK_DATA[task_id]['trans_result'] = result
+	TRANSLATION_EVENTS.setdefault(task_id, asyncio.Event()).set()
+
+def request_translation(task_id, texts) :
+	"""Called by inference workers once OCR is done, translation runs while the page is being inpainted."""
+	if task_id in TASK_DATA :
+		if 'manual' in TASK_DATA[task_id] :
+			# manual translation
+			asyncio.ensure_future(manual_trans_task(task_id, texts))
 		else :
-			return web.json_response({})
-	return web.json_response({})
+			# using machine trnaslation
+			asyncio.ensure_future(machine_trans_task(task_id, texts, TASK_DATA[task_id]['translator'], TASK_DATA[task_id]['tgt']))
+
+async def wait_translation_result(task_id, timeout) :
+	"""Called by inference workers, returns None if no result arrived within `timeout` seconds."""
+	if task_id not in TASK_DATA :
+		return None
+	if 'trans_result' not in TASK_DATA[task_id] :
+		event = TRANSLATION_EVENTS.setdefault(task_id, asyncio.Event())
+		try :
+			await asyncio.wait_for(event.wait(), timeout = timeout)
+		except asyncio.TimeoutError :
+			return None
+	if task_id not in TASK_DATA :
+		return None
+	return TASK_DATA[task_id].get('trans_result')
+
+def observe_translation(translator, seconds, error) :
+	if error is None :
+		TRANSLATION_SECONDS.observe(seconds, translator)
+	else :
+		TRANSLATION_ERRORS.inc(translator)
 
 async def machine_trans_task(task_id, texts, translator = 'youdao', target_language = 'CHS') :
 	print('translator', translator)
@@ -174,26 +494,25 @@ async def machine_trans_task(task_id, texts, translator = 'youdao', target_langu
 	if task_id not in TASK_DATA :
 		TASK_DATA[task_id] = {}
 	if texts :
-		success = False
-		for i in range(10) :
-			try :
-				TASK_DATA[task_id]['trans_result'] = await asyncio.wait_for(run_translation(translator, 'auto', target_language, texts), timeout = 15)
-				success = True
-				break
-			except Exception as ex :
-				continue
-		if not success :
-			TASK_DATA[task_id]['trans_result'] = 'error'
+		translators = [translator] + [t for t in TRANSLATOR_FAILOVER if t != translator]
+		try :
+			result = await dispatch_with_failover(translators, 'auto', target_language, texts, observer = observe_translation)
+		except Exception as ex :
+			print(f' -- Translation of task {task_id} failed: {ex}')
+			set_translation_result(task_id, 'error')
+			return
+		set_translation_result(task_id, result)
 	else :
-		TASK_DATA[task_id]['trans_result'] = []
+		set_translation_result(task_id, [])
 
 async def manual_trans_task(task_id, texts) :
 	if task_id not in TASK_DATA :
 		TASK_DATA[task_id] = {}
 	if texts :
 		TASK_DATA[task_id]['trans_request'] = [{'s': txt, 't': ''} for txt in texts]
+		notify_task(task_id)
 	else :
-		TASK_DATA[task_id]['trans_result'] = []
+		set_translation_result(task_id, [])
 		print('manual translation complete')
 
 @routes.post("/post-translation-result")
@@ -203,121 +522,110 @@ async def post_translation_result(request) :
 		task_id = rqjson['task_id']
 		if task_id in TASK_DATA :
 			trans_result = [r['t'] for r in rqjson['trans_result']]
-			TASK_DATA[task_id]['trans_result'] = trans_result
-			while True :
-				await asyncio.sleep(0.1)
-				if TASK_STATES[task_id] in ['error', 'error-lang', 'error-no-txt'] :
-					ret = web.json_response({'task_id' : task_id, 'status': 'failed'})
-					break
-				if TASK_STATES[task_id] == 'finished' :
-					ret = web.json_response({'task_id' : task_id, 'status': 'successful'})
-					break
+			set_translation_result(task_id, trans_result)
+			state = await wait_task_state(task_id, FINISHED_STATES)
+			if state == 'finished' :
+				ret = web.json_response({'task_id' : task_id, 'status': 'successful'})
+			else :
+				ret = web.json_response({'task_id' : task_id, 'status': 'failed'})
 			# remove old tasks
-			del TASK_STATES[task_id]
-			del TASK_DATA[task_id]
+			remove_task(task_id)
 			return ret
 	return web.json_response({})
 
-@routes.post("/request-translation-internal")
-async def request_translation_internal(request) :
-	global NONCE
-	rqjson = (await request.json())
-	if constant_compare(rqjson['nonce'], NONCE) :
-		task_id = rqjson['task_id']
-		if task_id in TASK_DATA :
-			if 'manual' in TASK_DATA[task_id] :
-				# manual translation
-				asyncio.gather(manual_trans_task(task_id, rqjson['texts']))
-			else :
-				# using machine trnaslation
-				asyncio.gather(machine_trans_task(task_id, rqjson['texts'], TASK_DATA[task_id]['translator'], TASK_DATA[task_id]['tgt']))
-	return web.json_response({})
-
-@routes.post("/get-translation-result-internal")
-async def get_translation_internal(request) :
-	global NONCE
-	rqjson = (await request.json())
-	if constant_compare(rqjson['nonce'], NONCE) :
-		task_id = rqjson['task_id']
-		if task_id in TASK_DATA :
-			if 'trans_result' in TASK_DATA[task_id] :
-				return web.json_response({'result': TASK_DATA[task_id]['trans_result']})
-	return web.json_response({})
+def get_task_progress(task_id) :
+	if task_id not in QUEUE_SEQ :
+		return {'state': TASK_STATES[task_id], 'waiting': 0, 'estimated_wait': 0}
+	seq, queued_before = QUEUE_SEQ[task_id]
+	return {'state': TASK_STATES[task_id], 'waiting': seq - NUM_POPPED + 1, 'estimated_wait': round(queue_wait_seconds(queued_before), 1)}
 
 @routes.get("/task-state")
 async def get_task_state_async(request) :
 	task_id = request.query.get('taskid')
 	if task_id and task_id in TASK_STATES and task_id in TASK_DATA :
-		try :
-			ret = web.json_response({'state': TASK_STATES[task_id], 'waiting': QUEUE.index(task_id) + 1})
-		except :
-			ret = web.json_response({'state': TASK_STATES[task_id], 'waiting': 0})
-		now = time.time()
-		to_del_task_ids = set()
-		for tid in TASK_STATES :
-			if tid in TASK_DATA and TASK_STATES[tid] in ['finished', 'error', 'error-lang'] and now - TASK_DATA[tid]['created_at'] > 1800 :
-				# remove old tasks
-				to_del_task_ids.add(tid)
-		for tid in to_del_task_ids :
-			del TASK_STATES[tid]
-			del TASK_DATA[tid]
-		return ret
+		return web.json_response(get_task_progress(task_id))
 	return web.json_response({'state': 'error'})
 
-@routes.post("/task-update-internal")
-async def post_task_update_async(request) :
-	global NONCE, NUM_ONGOING_TASKS
-	rqjson = (await request.json())
-	if constant_compare(rqjson['nonce'], NONCE) :
-		task_id = rqjson['task_id']
-		if task_id in TASK_STATES and task_id in TASK_DATA :
-			TASK_STATES[task_id] = rqjson['state']
-			if rqjson['state'] in ['finished', 'error', 'error-lang'] and 'manual' not in TASK_DATA[task_id] :
-				NUM_ONGOING_TASKS -= 1
-			print(f'Task state {task_id} to {TASK_STATES[task_id]}')
+@routes.get("/task-events")
+async def task_events_async(request) :
+	"""Server-sent events stream of `{state, waiting}` updates of a task, closed once the task is done."""
+	task_id = request.query.get('taskid')
+	resp = web.StreamResponse(headers = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+	await resp.prepare(request)
+	if not task_id or task_id not in TASK_STATES or task_id not in TASK_DATA :
+		await resp.write(b'data: {"state": "error"}\n\n')
+		return resp
+	last = None
+	while task_id in TASK_STATES and task_id in TASK_DATA :
+		progress = get_task_progress(task_id)
+		if progress != last :
+			await resp.write(f'data: {json.dumps(progress)}\n\n'.encode('utf-8'))
+			last = progress
+		if progress['state'] in FINISHED_STATES :
+			break
+		waiters = [asyncio.ensure_future(wait_task_changed(task_id))]
+		if progress['waiting'] :
+			waiters.append(asyncio.ensure_future(QUEUE_MOVED_EVENT.wait()))
+		done, pending = await asyncio.wait(waiters, timeout = 15, return_when = asyncio.FIRST_COMPLETED)
+		for w in pending :
+			w.cancel()
+		if not done :
+			# keep proxies from closing an idle connection
+			await resp.write(b': keep-alive\n\n')
+	return resp
+
+@routes.get("/task-trace")
+async def get_task_trace_async(request) :
+	task_id = request.query.get('taskid')
+	if task_id and task_id in TASK_DATA and 'trace' in TASK_DATA[task_id] :
+		return web.json_response(TASK_DATA[task_id]['trace'])
 	return web.json_response({})
 
 @routes.post("/submit")
 async def submit_async(request) :
 	x = await handle_post(request)
 	if isinstance(x, tuple) :
-		img, size, selected_translator, target_language, detector, direction = x
+		img, content, img_hash, size, selected_translator, target_language, detector, direction = x
 	else :
 		return x
-	task_id = f'{phash(img, hash_size = 16)}-{size}-{selected_translator}-{target_language}-{detector}-{direction}'
+	task_id = f'{img_hash}-{size}-{selected_translator}-{target_language}-{detector}-{direction}'
 	print(f'New `submit` task {task_id}')
-	if os.path.exists(f'result/{task_id}/final.png') :
+	await submit_task(task_id, img, content, {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()})
+	return web.json_response({'task_id' : task_id, 'status': 'successful'})
+
+async def submit_task(task_id, img, content, data, admit = True) :
+	# final.png is written before the worker reports `finished`, a task still in flight is joined instead
+	if not is_in_flight(task_id) and os.path.exists(f'result/{task_id}/final.png') :
+		touch_result(task_id)
+		RESULT_CACHE_REQUESTS.inc('hit')
 		TASK_STATES[task_id] = 'finished'
-		TASK_DATA[task_id] = {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()}
+		TASK_DATA[task_id] = data
+		persist_task(task_id)
+		schedule_expiry(task_id)
 	# elif os.path.exists(f'result/{task_id}') :
 	# 	# either image is being processed or error occurred 
 	# 	if task_id not in TASK_STATES :
 	# 		# error occurred
 	# 		return web.json_response({'state': 'error'})
 	else :
-		os.makedirs(f'result/{task_id}/', exist_ok=True)
-		img.save(f'result/{task_id}/input.png')
-		QUEUE.append(task_id)
-		TASK_DATA[task_id] = {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()}
-		TASK_STATES[task_id] = 'pending'
-	return web.json_response({'task_id' : task_id, 'status': 'successful'})
+		await start_task(task_id, img, content, data, admit)
 
 @routes.post("/manual-translate")
 async def manual_translate_async(request) :
-	x = await handle_post(request)
+	x = await handle_post(request, with_hash = False)
 	if isinstance(x, tuple) :
-		img, size, selected_translator, target_language, detector, direction = x
+		img, content, _, size, selected_translator, target_language, detector, direction = x
 	else :
 		return x
+	check_admission()
 	task_id = crypto_utils.rand_bytes(16).hex()
 	print(f'New `manual-translate` task {task_id}')
-	os.makedirs(f'result/{task_id}/', exist_ok=True)
-	img.save(f'result/{task_id}/input.png')
-	QUEUE.append(task_id)
+	await run_in_upload_executor(save_input, task_id, img, content)
 	TASK_DATA[task_id] = {'size': size, 'manual': True, 'detector': detector, 'direction': direction, 'created_at': time.time()}
 	TASK_STATES[task_id] = 'pending'
-	while True :
-		await asyncio.sleep(1)
+	persist_task(task_id)
+	enqueue_task(task_id)
+	while task_id in TASK_DATA :
 		if 'trans_request' in TASK_DATA[task_id] :
 			return web.json_response({'task_id' : task_id, 'status': 'pending', 'trans_result': TASK_DATA[task_id]['trans_request']})
 		if TASK_STATES[task_id] in ['error', 'error-lang'] :
@@ -325,29 +633,216 @@ async def manual_translate_async(request) :
 		if TASK_STATES[task_id] == 'finished' :
 			# no texts detected
 			return web.json_response({'task_id' : task_id, 'status': 'successful'})
+		await wait_task_changed(task_id)
 	return web.json_response({'task_id' : task_id, 'status': 'failed'})
 
+def natural_key(name) :
+	return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def safe_page_name(name, index) :
+	parts = [p for p in name.replace('\\', '/').split('/') if p and p not in ['.', '..']]
+	return '/'.join(parts) or f'{index:04d}'
+
+def list_archive_pages(content) :
+	"""Image entries of a ZIP/CBZ in reading order, None if there are too many or they are too large once extracted."""
+	with zipfile.ZipFile(io.BytesIO(content)) as zf :
+		infos = []
+		for info in zf.infolist() :
+			basename = os.path.basename(info.filename)
+			if not info.is_dir() and not basename.startswith('.') and basename.lower().endswith(JOB_IMAGE_EXTENSIONS) :
+				infos.append(info)
+	# zipfile never extracts more than the recorded file_size of an entry
+	if len(infos) > MAX_JOB_PAGES or sum(info.file_size for info in infos) > MAX_JOB_BYTES :
+		return None
+	return sorted(infos, key = lambda info: natural_key(info.filename))
+
+def read_archive_page(content, info) :
+	with zipfile.ZipFile(io.BytesIO(content)) as zf :
+		return zf.read(info)
+
+def hash_job_page(read) :
+	"""Hash of one page, None if it is not a usable image. The decoded page is dropped right away."""
+	_, img_hash = decode_upload(read(), True)
+	return img_hash
+
+def load_job_page(read) :
+	"""Read and decode one page, only `JOB_DECODE_BATCH` pages are held in memory at a time."""
+	content = read()
+	img, _ = decode_upload(content, False)
+	return img, content
+
+def needs_queueing(task_id) :
+	return not is_in_flight(task_id) and not os.path.exists(f'result/{task_id}/final.png')
+
+def build_job_archive(pages, path) :
+	tmp_path = f'{path}.tmp'
+	with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as zf :
+		for page in pages :
+			if page['state'] == 'finished' :
+				zf.write(f'result/{page["task_id"]}/final.png', arcname = os.path.splitext(page['name'])[0] + '.png')
+	os.replace(tmp_path, path)
+
+def get_job_progress(job_id) :
+	pages = []
+	for page in JOBS[job_id]['pages'] :
+		task_id = page['task_id']
+		if task_id in TASK_STATES and task_id in TASK_DATA :
+			progress = get_task_progress(task_id)
+		elif task_id is not None and os.path.exists(f'result/{task_id}/final.png') :
+			# task expired, its result is still there
+			progress = {'state': 'finished', 'waiting': 0, 'estimated_wait': 0}
+		else :
+			progress = {'state': 'error', 'waiting': 0, 'estimated_wait': 0}
+		pages.append({'name': page['name'], 'task_id': task_id, **progress})
+	num_done = sum(p['state'] in FINISHED_STATES for p in pages)
+	return {
+		'job_id': job_id,
+		'state': 'finished' if num_done == len(pages) else 'pending',
+		'total': len(pages),
+		'done': num_done,
+		'successful': sum(p['state'] == 'finished' for p in pages),
+		'pages': pages
+	}
+
+@routes.post("/job")
+async def job_async(request) :
+	"""Queue every page of a ZIP/CBZ or of several `file` fields as one job, each page is an ordinary task."""
+	data = await request.post()
+	size, selected_translator, target_language, detector, direction = parse_options(data)
+	# (name, function returning the page bytes), archive entries are only extracted when their page is decoded
+	pages = []
+	for field in data.getall('file', []) :
+		if isinstance(field, str) :
+			continue
+		content = field.file.read()
+		if zipfile.is_zipfile(io.BytesIO(content)) :
+			infos = await run_in_upload_executor(list_archive_pages, content)
+			if infos is None :
+				return web.json_response({'status' : 'failed'})
+			pages.extend((info.filename, functools.partial(read_archive_page, content, info)) for info in infos)
+		else :
+			pages.append((field.filename or '', lambda content = content: content))
+	if not pages or len(pages) > MAX_JOB_PAGES :
+		return web.json_response({'status' : 'failed'})
+	# first pass only hashes the pages, to find out how many of them really have to be queued
+	task_ids = []
+	for start in range(0, len(pages), JOB_DECODE_BATCH) :
+		hashes = await asyncio.gather(*[run_in_upload_executor(hash_job_page, read) for _, read in pages[start: start + JOB_DECODE_BATCH]], return_exceptions = True)
+		for img_hash in hashes :
+			if isinstance(img_hash, Exception) or img_hash is None :
+				task_ids.append(None)
+			else :
+				task_ids.append(f'{img_hash}-{size}-{selected_translator}-{target_language}-{detector}-{direction}')
+	num_new = len(set(task_id for task_id in task_ids if task_id is not None and needs_queueing(task_id)))
+	if MAX_QUEUE_SIZE > 0 and num_new > MAX_QUEUE_SIZE :
+		# would never be admitted, retrying does not help
+		return web.json_response({'status' : 'failed', 'reason' : f'{num_new} new pages, the queue holds at most {MAX_QUEUE_SIZE}'}, status = 413)
+	check_admission(num_new)
+	job_id = crypto_utils.rand_bytes(16).hex()
+	print(f'New job {job_id} with {len(pages)} pages, {num_new} to translate')
+	job_pages = []
+	for start in range(0, len(pages), JOB_DECODE_BATCH) :
+		batch = list(enumerate(zip(pages[start: start + JOB_DECODE_BATCH], task_ids[start: start + JOB_DECODE_BATCH]), start))
+		# pages translated or in flight already are joined without decoding them again
+		to_load = [(i, read) for (i, ((_, read), task_id)) in batch if task_id is not None and needs_queueing(task_id)]
+		decoded = await asyncio.gather(*[run_in_upload_executor(load_job_page, read) for _, read in to_load], return_exceptions = True)
+		loaded = dict(zip([i for i, _ in to_load], decoded))
+		for i, ((name, _), task_id) in batch :
+			name = safe_page_name(name, i)
+			ret = loaded.get(i, (None, None))
+			if task_id is None or isinstance(ret, Exception) or (i in loaded and ret[0] is None) :
+				job_pages.append({'name': name, 'task_id': None})
+				continue
+			img, content = ret
+			await submit_task(task_id, img, content, {'size': size, 'translator': selected_translator, 'tgt': target_language, 'detector': detector, 'direction': direction, 'created_at': time.time()}, admit = False)
+			job_pages.append({'name': name, 'task_id': task_id})
+	JOBS[job_id] = {'pages': job_pages, 'created_at': time.time()}
+	asyncio.get_running_loop().call_later(TASK_TTL, JOBS.pop, job_id, None)
+	return web.json_response({'job_id': job_id, 'pages': len(job_pages), 'status': 'successful'})
+
+@routes.get("/job-state")
+async def job_state_async(request) :
+	job_id = request.query.get('jobid')
+	if job_id and job_id in JOBS :
+		return web.json_response(get_job_progress(job_id))
+	return web.json_response({'state': 'error'})
+
+@routes.get("/job-result/{jobid}")
+async def job_result_async(request) :
+	"""A ZIP of the translated pages once every page is done, the progress with 202 until then."""
+	job_id = request.match_info.get('jobid')
+	if job_id not in JOBS :
+		raise web.HTTPNotFound()
+	progress = get_job_progress(job_id)
+	if progress['state'] != 'finished' :
+		return web.json_response(progress, status = 202)
+	path = f'result/job-{job_id}/{job_id}.zip'
+	if not os.path.exists(path) :
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		await run_in_upload_executor(build_job_archive, progress['pages'], path)
+		if RESULT_STORE is not None :
+			asyncio.ensure_future(store_result(f'job-{job_id}'))
+	return web.FileResponse(path, headers = {'Content-Disposition': f'attachment; filename="{job_id}.zip"'})
+
 app.add_routes(routes)
 
-async def start_async_app() :
-	# schedule web server to run
-	global NONCE
-	NONCE = sys.argv[1]
-	host = sys.argv[2]
-	port = int(sys.argv[3])
+async def on_cleanup(app) :
+	await close_translator_sessions()
+
+app.on_cleanup.append(on_cleanup)
+
+def restore_tasks() :
+	"""Reload tasks recorded by a previous run, unfinished ones are queued again."""
+	now = time.time()
+	num_queued = 0
+	for task_id, state, data in TASK_STORE.load() :
+		if state in FINISHED_STATES :
+			if data.get('created_at', 0) + TASK_TTL <= now :
+				TASK_STORE.remove(task_id)
+				continue
+			TASK_DATA[task_id] = data
+			TASK_STATES[task_id] = state
+			schedule_expiry(task_id)
+		elif 'manual' in data or not os.path.exists(f'result/{task_id}/input.png') :
+			# nobody is left to type a manual translation
+			TASK_STORE.remove(task_id)
+		else :
+			TASK_DATA[task_id] = data
+			TASK_STATES[task_id] = 'pending'
+			TASK_STORE.set_state(task_id, 'pending')
+			enqueue_task(task_id)
+			num_queued += 1
+	print(f' -- Restored {len(TASK_STATES)} tasks from {TASK_STORE.path}, {num_queued} queued again')
+
+async def start_async_app(host, port, num_workers = 1, result_cache_size = 0, task_db = '', max_queue_size = 0, translator_failover = []) :
+	"""Start serving on the running loop, inference workers `0` to `num_workers - 1` pick tasks up through `wait_for_task`.
+
+	With `result_cache_size` (in bytes) the least recently used task directories of `result/` are removed past that size.
+	With `task_db` tasks are recorded in that SQLite file and queued work is resumed on the next start.
+	With `max_queue_size` new tasks are refused with 429 while that many are waiting.
+	Machine translation falls back to the translators of `translator_failover` in order.
+	"""
+	global QUEUE_EVENT, QUEUE_MOVED_EVENT, RESULT_STORE, EVICT_EVENT, TASK_STORE, MAX_QUEUE_SIZE, TRANSLATOR_FAILOVER
+	MAX_QUEUE_SIZE = max_queue_size
+	TRANSLATOR_FAILOVER = list(translator_failover)
+	set_rate_limit_observer(lambda translator, seconds: TRANSLATION_RATE_LIMIT_WAIT.observe(seconds, translator))
+	QUEUE_EVENT = asyncio.Event()
+	QUEUE_MOVED_EVENT = asyncio.Event()
+	if task_db :
+		TASK_STORE = TaskStore(task_db)
+		restore_tasks()
+	asyncio.ensure_future(expire_tasks_forever())
+	if result_cache_size > 0 :
+		RESULT_STORE = await run_in_upload_executor(ResultStore, 'result', result_cache_size)
+		print(f' -- Result store holds {RESULT_STORE.total_size / 1024 / 1024:.1f}MB, limit {result_cache_size / 1024 / 1024:.1f}MB')
+		EVICT_EVENT = asyncio.Event()
+		EVICT_EVENT.set()
+		asyncio.ensure_future(evict_results_forever())
+	for worker_id in range(num_workers) :
+		WORKER_TASKS[worker_id] = 0
 	runner = web.AppRunner(app)
 	await runner.setup()
 	site = web.TCPSite(runner, host, port)
 	await site.start()
 	print(f"Serving up app on http://{host}:{port}")
 	return runner, site
-
-if __name__ == '__main__' :
-	loop = asyncio.get_event_loop()
-	runner, site = loop.run_until_complete(start_async_app())
-
-	try:
-		loop.run_forever()
-	except KeyboardInterrupt as err :
-		loop.run_until_complete(runner.cleanup())
-